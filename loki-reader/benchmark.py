@@ -0,0 +1,243 @@
+"""
+Micro-benchmarks of the ingest hot path on synthetic workloads.
+
+For each fleet size a fresh process generates a seeded workload
+(synthetic_workload.py) and measures:
+
+- query_range_parse: a serialized query_range response body fed in chunks
+  through LokiResponseParser and LokiLogReader._decode_entry, as _fetch_page
+  does in window and cursor mode
+- parse: LokiLogReader._parse_results over decoded result streams (tail mode)
+- update: MetricsState.update_metrics per event (batched, as in ingest_logs)
+- project_status: MetricsState._update_project_status per project
+- unresponsive_sweep / reset_sweep: MetricsState._check_unresponsive_servers
+  once every server's unresponsive / reset deadline is due
+
+Throughput, per-call latency percentiles and the process's peak RSS are
+printed and written as JSON; pass --compare with an earlier result file to
+see the change of every figure against it.
+
+    python benchmark.py --servers 10,1000,50000 --events 200000 --output bench.json
+    python benchmark.py --output bench-new.json --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+# Keep the benchmark away from the service's logs and checkpoint
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'loki-reader-benchmark'))
+os.environ.setdefault('CHECKPOINT_INTERVAL_SECONDS', '0')
+os.environ.setdefault('MAX_SERIES', '0')
+
+from loki_reader import EventClock, LokiLogReader, LokiResponseParser, MetricsState, StreamCursor
+from synthetic_workload import DEFAULT_MIX, SyntheticWorkload, parse_mix
+
+STREAMS = 4  # collector pods the lines are spread over
+CHUNK_SIZE = 64 * 1024  # response body chunk size, as read by _fetch_page
+
+
+def percentiles(latencies_ns):
+    """Latency summary in microseconds"""
+    latencies_ns.sort()
+    count = len(latencies_ns)
+
+    def at(fraction):
+        return latencies_ns[min(count - 1, int(fraction * count))] / 1000
+
+    return {'p50_us': at(0.50), 'p90_us': at(0.90), 'p99_us': at(0.99), 'max_us': latencies_ns[-1] / 1000}
+
+
+def timed_calls(calls):
+    """Run every call, returning (calls/sec, per-call latencies in ns)"""
+    perf_counter_ns = time.perf_counter_ns
+    latencies = []
+    started = perf_counter_ns()
+    for call, args in calls:
+        before = perf_counter_ns()
+        call(*args)
+        latencies.append(perf_counter_ns() - before)
+    elapsed = perf_counter_ns() - started
+    return len(latencies) / (elapsed / 1_000_000_000), latencies
+
+
+def stage_result(rate, latencies, unit='events'):
+    return {f'{unit}_per_sec': rate, 'calls': len(latencies), **percentiles(latencies)}
+
+
+def timed_entries(entries):
+    """Drain an entry iterator, returning (entries, entries/sec, per-entry latencies in ns)"""
+    perf_counter_ns = time.perf_counter_ns
+    collected = []
+    latencies = []
+    started = perf_counter_ns()
+    while True:
+        before = perf_counter_ns()
+        entry = next(entries, None)
+        latencies.append(perf_counter_ns() - before)
+        if entry is None:
+            break
+        collected.append(entry)
+    elapsed = perf_counter_ns() - started
+    latencies.pop()
+    return collected, len(collected) / (elapsed / 1_000_000_000), latencies
+
+
+def query_range_entries(chunks):
+    """Decoded entries of a query_range body, the way _fetch_page reads them"""
+    decode_entry = LokiLogReader._decode_entry
+    labels = stream_key = None
+    for entry_labels, timestamp, log_line in LokiResponseParser(chunks).entries():
+        if entry_labels is not labels:
+            labels = entry_labels
+            stream_key = StreamCursor.stream_key(labels)
+        entry = decode_entry(int(timestamp), stream_key, log_line)
+        if entry is not None:
+            yield entry
+
+
+def run_scenario(servers, events, seed, mix):
+    """Benchmark one fleet size; runs in its own process so peak RSS is per scenario"""
+    workload = SyntheticWorkload(servers, mix=mix, seed=seed, start_ns=0)
+    results = {}
+
+    # Loki-style result streams of collector lines, each in time order
+    streams = [{'stream': {'app': 'otel-collector', 'pod': f'collector-{index}'}, 'values': []}
+               for index in range(STREAMS)]
+    for index, (timestamp, line) in enumerate(workload.lines(events)):
+        streams[index % STREAMS]['values'].append([str(timestamp), f"Body: Map({line})"])
+
+    body = json.dumps({'status': 'success', 'data': {'resultType': 'streams', 'result': streams}}).encode()
+    chunks = [body[offset:offset + CHUNK_SIZE] for offset in range(0, len(body), CHUNK_SIZE)]
+    del body
+    _, rate, latencies = timed_entries(query_range_entries(chunks))
+    results['query_range_parse'] = stage_result(rate, latencies)
+    del chunks
+
+    reader = LokiLogReader()
+    entries, rate, latencies = timed_entries(reader._parse_results(streams))
+    results['parse'] = stage_result(rate, latencies)
+    del streams
+
+    clock = EventClock()
+    state = MetricsState(clock)
+    state.batching = True
+    update = state.update_metrics
+    perf_counter_ns = time.perf_counter_ns
+    events_args = [
+        (entry.server_id, entry.project_key, entry.msg_type, entry.timestamp, entry.event_key)
+        for entry in entries
+    ]
+    del entries
+    clock.advance(events_args[-1][3])
+    rate, latencies = timed_calls((update, args) for args in events_args)
+    results['update'] = stage_result(rate, latencies)
+    started = perf_counter_ns()
+    state.batching = False
+    state.flush()
+    results['flush_ms'] = (perf_counter_ns() - started) / 1_000_000
+
+    rate, latencies = timed_calls((state._update_project_status, (project_key,))
+                                  for project_key in list(state.project_servers))
+    results['project_status'] = stage_result(rate, latencies, 'projects')
+
+    for name, timeout_ns in (('unresponsive_sweep', MetricsState._unresponsive_timeout_ns()),
+                             ('reset_sweep', MetricsState._reset_timeout_ns())):
+        clock.advance(clock() + timeout_ns + 1)
+        started = perf_counter_ns()
+        state._check_unresponsive_servers()
+        elapsed = perf_counter_ns() - started
+        results[name] = {
+            'servers': len(state.server_sessions),
+            'duration_ms': elapsed / 1_000_000,
+            'servers_per_sec': len(state.server_sessions) / (elapsed / 1_000_000_000),
+        }
+
+    # ru_maxrss is in KiB on Linux
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results['servers'] = servers
+    results['projects'] = len(state.project_servers)
+    results['events'] = len(events_args)
+    return results
+
+
+def flatten(scenario):
+    """(figure name, value) pairs of one scenario result"""
+    for stage, value in scenario.items():
+        if isinstance(value, dict):
+            for name, figure in value.items():
+                yield f'{stage}.{name}', figure
+        elif stage not in ('servers', 'projects', 'events'):
+            yield stage, value
+
+
+def print_results(results, baseline=None):
+    baseline_by_servers = {
+        scenario['servers']: dict(flatten(scenario)) for scenario in (baseline or {}).get('scenarios', [])
+    }
+    for scenario in results['scenarios']:
+        print(f"\n{scenario['servers']} servers, {scenario['projects']} projects, {scenario['events']} events")
+        previous = baseline_by_servers.get(scenario['servers'], {})
+        for name, value in flatten(scenario):
+            line = f"  {name:32} {value:14.2f}"
+            if name in previous and previous[name]:
+                line += f"  {(value - previous[name]) / previous[name] * 100:+7.1f}%"
+            print(line)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ingest hot path on synthetic workloads')
+    parser.add_argument('--servers', default='10,1000,50000', help='comma-separated fleet sizes')
+    parser.add_argument('--events', type=int, default=200000, help='events per fleet size')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='messagetypeid weights, e.g. 5=90,15=8,3=1,1=1')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'seed': args.seed,
+            'events': args.events,
+            'mix': args.mix,
+        },
+        'scenarios': [],
+    }
+    for servers in (int(value) for value in args.servers.split(',')):
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            results['scenarios'].append(
+                executor.submit(run_scenario, servers, args.events, args.seed, args.mix).result()
+            )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
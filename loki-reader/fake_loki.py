@@ -0,0 +1,176 @@
+"""
+Local fake Loki server for exercising the reader without a real Loki.
+
+Serves /loki/api/v1/query_range (with limit, direction and [start, end)
+semantics matching Loki) and the /loki/api/v1/tail websocket on one port.
+The LogQL query itself is ignored: every pushed entry matches.
+
+Run standalone and point the reader at it:
+
+    python fake_loki.py --port 3100 --rate 20
+    Loki_SERVER_HOST=127.0.0.1 INGEST_MODE=tail python loki_reader.py
+"""
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
+
+from websockets.sync.server import serve
+
+
+class FakeLoki:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.entries = []  # sorted (timestamp_ns, labels_json, line)
+        self.query_count = 0
+        self.truncated_count = 0  # query_range responses cut off at `limit`
+        self.bytes_served = 0
+        self.tail_count = 0
+        self._tail_generation = 0  # bumped by drop_tails()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._server = serve(self._handle_tail, self.host, self.port, process_request=self._process_request)
+        self.port = self._server.socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-loki', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close open tail connections"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._server:
+            self._server.shutdown()
+
+    def drop_tails(self):
+        """Close the open tail connections, as a Loki restart would"""
+        with self._condition:
+            self._tail_generation += 1
+            self._condition.notify_all()
+
+    def push(self, labels, line, timestamp=None):
+        """Store one log line for a stream and wake up tail connections"""
+        timestamp = timestamp or time.time_ns()
+        with self._condition:
+            bisect.insort(self.entries, (timestamp, json.dumps(labels, sort_keys=True), line))
+            self._condition.notify_all()
+
+    def _select(self, start, end, limit=None, direction='forward'):
+        with self._condition:
+            low = bisect.bisect_left(self.entries, (start,))
+            high = bisect.bisect_left(self.entries, (end,))
+            selected = self.entries[low:high]
+        if direction == 'backward':
+            selected = selected[::-1]
+        return selected[:limit] if limit else selected
+
+    @staticmethod
+    def _to_streams(entries):
+        streams = {}
+        for timestamp, labels, line in entries:
+            streams.setdefault(labels, []).append([str(timestamp), line])
+        return [{'stream': json.loads(labels), 'values': values} for labels, values in streams.items()]
+
+    def _process_request(self, connection, request):
+        url = urlparse(request.path)
+        if url.path == '/loki/api/v1/tail':
+            return None  # continue with the websocket handshake
+
+        if url.path != '/loki/api/v1/query_range':
+            return connection.respond(HTTPStatus.NOT_FOUND, "not found\n")
+
+        params = parse_qs(url.query)
+        now = time.time_ns()
+        start = int(params.get('start', [now - 3600 * 1_000_000_000])[0])
+        end = int(params.get('end', [now])[0])
+        limit = int(params.get('limit', ['100'])[0])
+        direction = params.get('direction', ['backward'])[0]
+
+        self.query_count += 1
+        selected = self._select(start, end, limit, direction)
+        if len(selected) == limit:
+            self.truncated_count += 1
+        body = json.dumps({
+            'status': 'success',
+            'data': {
+                'resultType': 'streams',
+                'result': self._to_streams(selected),
+            },
+        })
+        self.bytes_served += len(body)
+        response = connection.respond(HTTPStatus.OK, body)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    def _handle_tail(self, websocket):
+        params = parse_qs(urlparse(websocket.request.path).query)
+        position = int(params.get('start', [time.time_ns() - 3600 * 1_000_000_000])[0])
+        limit = int(params.get('limit', ['100'])[0])
+        self.tail_count += 1
+        generation = self._tail_generation
+
+        try:
+            while not self._stopped and generation == self._tail_generation:
+                with self._condition:
+                    entries = self._select(position, float('inf'), limit)
+                    if not entries:
+                        self._condition.wait(1)
+                        continue
+                position = entries[-1][0] + 1
+                websocket.send(json.dumps({'streams': self._to_streams(entries)}))
+        except Exception:
+            pass  # client went away or the server is shutting down
+
+
+def activity_log(server_id, project_key, msg_type, timestamp):
+    """Render an ActivityLog body the way the collector pipeline stores it"""
+    return json.dumps({
+        '_class': 'com.magicsoftware.xpi.info.data.ActivityLog',
+        'createdTimeInNanoSec': timestamp,
+        'messagetypeid': msg_type,
+        'projectkey': project_key,
+        'serverid': server_id,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Loki query_range/tail server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3100)
+    parser.add_argument('--rate', type=float, default=10, help='log lines generated per second')
+    parser.add_argument('--servers', type=int, default=5)
+    args = parser.parse_args()
+
+    loki = FakeLoki(args.host, args.port).start()
+    print(f"Fake Loki listening on {loki.url}")
+
+    labels = {'app': 'otel-collector'}
+    for server_id in range(args.servers):
+        loki.push(labels, activity_log(server_id, f"project{server_id % 2}", 1, time.time_ns()))
+    try:
+        while True:
+            time.sleep(1 / args.rate)
+            server_id = random.randrange(args.servers)
+            msg_type = random.choices([5, 15, 3], weights=[90, 9, 1])[0]
+            loki.push(labels, activity_log(server_id, f"project{server_id % 2}", msg_type, time.time_ns()))
+    except KeyboardInterrupt:
+        loki.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+End-to-end throughput harness: the real reader loop against a fake Loki and
+a fake Pushgateway.
+
+An in-process FakeLoki (fake_loki.py) is fed by the synthetic workload
+generator (synthetic_workload.py) at each rate of --rates in turn, and a
+FakePushgateway records what the reader pushes. loki_reader.main() runs in
+this process against both until the last load step has drained.
+
+Per load step it reports the emitted event rate, reader cycles/sec, bytes
+pushed, emit-to-push latency (from an event entering Loki to the first push
+whose latest_transaction_time for its server covers it), the backlog of
+emitted events no push has covered yet, and Loki queries/truncated responses.
+At the end the flow and error totals pushed per server are compared with what
+was emitted to count dropped (or double-counted) events. The first step whose
+backlog or latency keeps growing past a few push intervals is reported as the
+saturation point.
+
+The default mix has no stops or restarts, so pushed session totals can be
+compared with emitted counts exactly. Aggregation pushdown and otlp mode are
+not supported: the fake Loki does not evaluate metric queries.
+
+    python harness.py --rates 100,1000,5000 --step-seconds 60 --mode window --push-interval 5
+"""
+import argparse
+import gzip
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from fake_loki import FakeLoki
+from synthetic_workload import SyntheticWorkload, parse_mix
+
+LABELS = {'app': 'otel-collector'}
+TOTALS = {5: 'total_flows_current_session', 15: 'total_errors_current_session'}
+
+
+class FakePushgateway:
+    """Accepts Pushgateway pushes and deletes, recording (receive time, bytes, job)
+    of each and the newest session totals per server"""
+
+    def __init__(self, host='127.0.0.1', port=0, on_push=None):
+        self.host = host
+        self.port = port
+        self.on_push = on_push  # called with (receive time, {serverid: latest_transaction_time})
+        self.lock = threading.Lock()
+        self.pushes = []
+        self.totals = {}  # (metric name, serverid) -> value
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                gateway._record(self.command, self.path, self.headers, body)
+                self.send_response(202 if self.command == 'DELETE' else 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_PUT = do_POST = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, name='fake-pushgateway', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+
+    def _record(self, method, path, headers, body):
+        received = time.time_ns()
+        size = len(body)
+        if headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        parts = path.split('/')
+        job = parts[3] if len(parts) > 3 else ''
+
+        transaction_times = {}
+        totals = {}
+        if method != 'DELETE' and body:
+            for family in text_string_to_metric_families(body.decode()):
+                if family.name == 'latest_transaction_time':
+                    for sample in family.samples:
+                        transaction_times[sample.labels['serverid']] = sample.value
+                elif family.name in TOTALS.values():
+                    for sample in family.samples:
+                        totals[(family.name, sample.labels['serverid'])] = sample.value
+
+        with self.lock:
+            self.pushes.append((received, size, job))
+            self.totals.update(totals)
+        if self.on_push and transaction_times:
+            self.on_push(received, transaction_times)
+
+
+class LoadGenerator:
+    """Feeds FakeLoki with synthetic ActivityLog lines at `rate` events/sec and
+    tracks which emitted events pushes have covered"""
+
+    TICK_SECONDS = 0.01
+
+    def __init__(self, loki, workload):
+        self.loki = loki
+        self.workload = workload
+        self.events = workload.events(sys.maxsize)
+        self.rate = 0
+        self.lock = threading.Lock()
+        self.pending = defaultdict(deque)  # serverid -> emit times not covered by a push yet
+        self.emitted = 0
+        self.emitted_totals = Counter()  # (metric name, serverid) -> events emitted
+        self.latencies = []  # (receive time, emit-to-push latency in ns)
+        self._stop_event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='load-generator', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    def backlog(self):
+        with self.lock:
+            return sum(len(pending) for pending in self.pending.values())
+
+    def _run(self):
+        next_tick = time.monotonic()
+        owed = 0.0
+        while not self._stop_event.is_set():
+            owed += self.rate * self.TICK_SECONDS
+            count = int(owed)
+            owed -= count
+            for _ in range(count):
+                self._emit()
+            next_tick += self.TICK_SECONDS
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()  # falling behind: drop the owed ticks, not the rate
+
+    def _emit(self):
+        _, server_id, project_key, msg_type = next(self.events)
+        timestamp = time.time_ns()
+        line = json.dumps(self.workload.payload(timestamp, server_id, project_key, msg_type), separators=(',', ':'))
+        self.loki.push(LABELS, line, timestamp)
+        with self.lock:
+            self.pending[str(server_id)].append(timestamp)
+            self.emitted += 1
+            if msg_type in TOTALS:
+                self.emitted_totals[(TOTALS[msg_type], str(server_id))] += 1
+
+    def on_push(self, received, transaction_times):
+        with self.lock:
+            for server_id, transaction_time in transaction_times.items():
+                pending = self.pending.get(server_id)
+                # Pushed values are floats, so allow for their rounding
+                while pending and pending[0] <= transaction_time + 1024:
+                    self.latencies.append((received, received - pending.popleft()))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(steps, generator, gateway, reader_job, push_interval):
+    results = []
+    for step in steps:
+        start, end = step['start'], step['end']
+        seconds = (end - start) / 1_000_000_000
+        with gateway.lock:
+            pushes = [push for push in gateway.pushes if start <= push[0] < end]
+        with generator.lock:
+            latencies = [latency / 1_000_000 for received, latency in generator.latencies if start <= received < end]
+        results.append({
+            'rate': step['rate'],
+            'emitted_per_sec': step['emitted'] / seconds,
+            'cycles_per_sec': sum(1 for push in pushes if push[2] == reader_job) / seconds,
+            'push_requests': len(pushes),
+            'bytes_pushed': sum(push[1] for push in pushes),
+            'latency_p50_ms': percentile(latencies, 0.50),
+            'latency_p99_ms': percentile(latencies, 0.99),
+            'latency_max_ms': max(latencies) if latencies else None,
+            'backlog_at_end': step['backlog'],
+            'loki_queries': step['loki_queries'],
+            'loki_truncated': step['loki_truncated'],
+        })
+
+    saturated_at = None
+    for result in results:
+        latency_limit = 3 * push_interval * 1000
+        if (result['backlog_at_end'] > 2 * result['rate'] * push_interval
+                or (result['latency_p99_ms'] or 0) > latency_limit):
+            saturated_at = result['rate']
+            break
+
+    with gateway.lock:
+        counted = dict(gateway.totals)
+    with generator.lock:
+        emitted = dict(generator.emitted_totals)
+    missing = sum(max(0, count - counted.get(key, 0)) for key, count in emitted.items())
+    extra = sum(max(0, counted.get(key, 0) - count) for key, count in emitted.items())
+    return {
+        'steps': results,
+        'saturated_at_rate': saturated_at,
+        'events_emitted': generator.emitted,
+        'events_dropped': missing,
+        'events_double_counted': extra,
+        'backlog_after_drain': generator.backlog(),
+    }
+
+
+def print_summary(summary):
+    print(f"\n{'rate':>8} {'emit/s':>9} {'cycles/s':>9} {'pushes':>7} {'bytes':>11} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'backlog':>8} {'queries':>8} {'trunc':>6}")
+    for step in summary['steps']:
+        def fmt(value):
+            return f"{value:9.1f}" if value is not None else f"{'-':>9}"
+        print(f"{step['rate']:>8} {step['emitted_per_sec']:9.1f} {step['cycles_per_sec']:9.3f} "
+              f"{step['push_requests']:>7} {step['bytes_pushed']:>11} {fmt(step['latency_p50_ms'])} "
+              f"{fmt(step['latency_p99_ms'])} {fmt(step['latency_max_ms'])} {step['backlog_at_end']:>8} "
+              f"{step['loki_queries']:>8} {step['loki_truncated']:>6}")
+    print(f"\nEmitted {summary['events_emitted']} events; dropped {summary['events_dropped']}, "
+          f"double-counted {summary['events_double_counted']}, uncovered after drain {summary['backlog_after_drain']}")
+    if summary['saturated_at_rate'] is not None:
+        print(f"Saturated at {summary['saturated_at_rate']} events/sec")
+    else:
+        print("Not saturated at any tested rate")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the reader end to end against a fake Loki and Pushgateway')
+    parser.add_argument('--rates', default='100,1000,5000', help='comma-separated events/sec of each load step')
+    parser.add_argument('--step-seconds', type=float, default=60)
+    parser.add_argument('--mode', choices=['window', 'cursor', 'tail'], default='window', help='INGEST_MODE')
+    parser.add_argument('--push-interval', type=int, default=5, help='PUSH_INTERVAL_SECONDS')
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--projects', type=int, default=None)
+    parser.add_argument('--mix', type=parse_mix, default={5: 95, 15: 5},
+                        help='messagetypeid weights; types 1 and 3 reset session totals, so dropped '
+                             'events are only counted exactly without them')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args()
+
+    loki = FakeLoki().start()
+    workload = SyntheticWorkload(args.servers, args.projects, args.mix, args.seed)
+    generator = LoadGenerator(loki, workload)
+    gateway = FakePushgateway(on_push=generator.on_push).start()
+
+    # The reader reads its configuration on import
+    work_dir = tempfile.mkdtemp(prefix='loki-reader-harness-')
+    os.environ.update({
+        'Loki_SERVER_HOST': loki.host,
+        'Loki_SERVER_PORT': str(loki.port),
+        'PROMETHEUS_GATEWAY': gateway.url,
+        'METRICS_SINK': 'pushgateway',
+        'INGEST_MODE': args.mode,
+        'PUSH_INTERVAL_SECONDS': str(args.push_interval),
+        'AGGREGATION_PUSHDOWN': 'false',
+        'SHARDS': '1',
+    })
+    os.environ.setdefault('LOG_DIR', os.path.join(work_dir, 'logs'))
+    os.environ.setdefault('STATE_DIR', os.path.join(work_dir, 'state'))
+    os.environ.setdefault('CHECKPOINT_INTERVAL_SECONDS', '0')
+    import loki_reader
+
+    rates = [int(rate) for rate in args.rates.split(',')]
+    steps = []
+
+    def drive():
+        generator.start()
+        for rate in rates:
+            step = {'rate': rate, 'start': time.time_ns(), 'emitted_before': generator.emitted,
+                    'queries_before': loki.query_count, 'truncated_before': loki.truncated_count}
+            generator.rate = rate
+            print(f"Load step: {rate} events/sec for {args.step_seconds:.0f}s", flush=True)
+            time.sleep(args.step_seconds)
+            step.update(end=time.time_ns(), emitted=generator.emitted - step['emitted_before'],
+                        backlog=generator.backlog(), loki_queries=loki.query_count - step['queries_before'],
+                        loki_truncated=loki.truncated_count - step['truncated_before'])
+            steps.append(step)
+        generator.rate = 0
+        generator.stop()
+        print("Draining", flush=True)
+        time.sleep(3 * args.push_interval)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=drive, name='harness-driver', daemon=True).start()
+    sys.argv[1:] = []
+    try:
+        loki_reader.main()
+    except SystemExit:
+        print("Reader exited early", file=sys.stderr)
+
+    summary = summarize(steps, generator, gateway, loki_reader.Config.READER_JOB_NAME, args.push_interval)
+    summary['config'] = {'mode': args.mode, 'push_interval': args.push_interval, 'servers': args.servers,
+                         'step_seconds': args.step_seconds, 'mix': args.mix, 'seed': args.seed}
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    gateway.stop()
+    loki.stop()
+
+
+if __name__ == '__main__':
+    main()
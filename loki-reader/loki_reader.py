@@ -1,16 +1,56 @@
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime, timedelta
+import re
+import codecs
+from datetime import datetime
 import pytz
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, delete_from_gateway, push_to_gateway, pushadd_to_gateway, start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily, Metric
 import time
-from collections import defaultdict
+import math
+import random
+import base64
+import signal
+import zlib
+import heapq
+from array import array
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import multiprocessing
+import queue
+import gzip
+import tempfile
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
 import traceback
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from dotenv import load_dotenv
+from websockets.sync.client import connect as websocket_connect
+
+# Protobuf OTLP bodies are only needed by the OTLP receiver
+try:
+    from google.protobuf.json_format import MessageToDict
+    from opentelemetry.proto.collector.logs.v1 import logs_service_pb2
+except ImportError:
+    logs_service_pb2 = None
+
+# orjson decodes log lines several times faster; fall back to the std-lib decoder
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Load environment variables
 load_dotenv()
@@ -25,6 +65,27 @@ class Config:
     # Prometheus Configuration
     PROMETHEUS_GATEWAY = os.getenv('PROMETHEUS_GATEWAY', 'http://10.9.8.59:9091')
     PROMETHEUS_JOB_NAME = os.getenv('PROMETHEUS_JOB_NAME', 'summary_metrics')
+    # pushgateway: push REGISTRY every cycle; http: serve /metrics generated from
+    # the state at scrape time; both: do both
+    METRICS_SINK = os.getenv('METRICS_SINK', 'pushgateway').lower()
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '8080'))
+    # full: replace the whole job with every series each cycle; grouped: pushadd only
+    # the projects changed since the last successful push, one group per projectkey
+    PUSH_MODE = os.getenv('PUSH_MODE', 'grouped').lower()
+    # Job under which the reader's own metrics (READER_REGISTRY) are pushed
+    READER_JOB_NAME = os.getenv('READER_JOB_NAME', 'loki_reader')
+    # gzip-compress Pushgateway request bodies (needs Pushgateway >= 1.5)
+    PUSH_GZIP = os.getenv('PUSH_GZIP', 'false').lower() == 'true'
+
+    # HTTP Configuration
+    # Loki and the Pushgateway each get a keep-alive connection pool; failed
+    # requests are retried HTTP_RETRIES times with jittered exponential backoff,
+    # and after BREAKER_FAILURE_THRESHOLD consecutive failures an endpoint's
+    # circuit opens and requests to it fail fast for BREAKER_RESET_SECONDS
+    HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+    HTTP_RETRY_BACKOFF_SECONDS = float(os.getenv('HTTP_RETRY_BACKOFF_SECONDS', '0.5'))
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+    BREAKER_RESET_SECONDS = int(os.getenv('BREAKER_RESET_SECONDS', '30'))
 
     # Logging Configuration
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
@@ -32,6 +93,13 @@ class Config:
     LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', '10485760'))
     LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
     ENABLE_CONSOLE_LOG = os.getenv('ENABLE_CONSOLE_LOG', 'false').lower() == 'true'
+    # Log records are queued (at most LOG_QUEUE_SIZE, further ones are dropped) and
+    # written by a background thread; per-event messages are limited to
+    # LOG_SAMPLE_RATE per message kind per second (0: no limit)
+    LOG_ASYNC = os.getenv('LOG_ASYNC', 'true').lower() == 'true'
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+    LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', '10'))
+    _log_listener = None
     
     # Log file names with timestamps
     @staticmethod
@@ -43,6 +111,66 @@ class Config:
     ERROR_TIMEOUT_HOURS = int(os.getenv('ERROR_TIMEOUT_HOURS', '1'))
     UNRESPONSIVE_TIMEOUT_MINUTES = int(os.getenv('UNRESPONSIVE_TIMEOUT_MINUTES', '5'))
     RESET_TIMEOUT_HOURS = int(os.getenv('RESET_TIMEOUT_HOURS', '3'))
+    WINDOW_BUCKET_SECONDS = int(os.getenv('WINDOW_BUCKET_SECONDS', '60'))
+
+    # Series Lifecycle Configuration
+    # A stopped server's series are removed SERIES_RETENTION_HOURS after it
+    # stopped and went quiet (0 keeps them); beyond MAX_SERIES series (0: no cap)
+    # the least recently seen servers are evicted, stopped ones first
+    SERIES_RETENTION_HOURS = int(os.getenv('SERIES_RETENTION_HOURS', '24'))
+    MAX_SERIES = int(os.getenv('MAX_SERIES', '500000'))
+
+    # Deduplication Configuration
+    # Events older than the newest event minus DEDUP_LATENESS_SECONDS are dropped
+    # as late; newer ones are checked against an index of at most DEDUP_CAPACITY keys
+    DEDUP_LATENESS_SECONDS = int(os.getenv('DEDUP_LATENESS_SECONDS', '120'))
+    DEDUP_CAPACITY = int(os.getenv('DEDUP_CAPACITY', '100000'))
+
+    # Ingest Configuration
+    # window: re-query the last UNRESPONSIVE_TIMEOUT_MINUTES every cycle
+    # cursor: only query entries newer than the persisted per-stream cursor
+    # tail: stream entries from Loki's tail websocket as they arrive
+    # otlp: receive OTLP/HTTP logs from the collector directly, bypassing Loki
+    INGEST_MODE = os.getenv('INGEST_MODE', 'window').lower()
+    OTLP_RECEIVER_HOST = os.getenv('OTLP_RECEIVER_HOST', '0.0.0.0')
+    OTLP_RECEIVER_PORT = int(os.getenv('OTLP_RECEIVER_PORT', '4318'))
+    TAIL_LIMIT = int(os.getenv('TAIL_LIMIT', '5000'))
+    PUSH_INTERVAL_SECONDS = int(os.getenv('PUSH_INTERVAL_SECONDS', '60'))
+    # sync: sleep PUSH_INTERVAL_SECONDS after each cycle; asyncio: start cycles on a
+    # fixed PUSH_INTERVAL_SECONDS schedule and overlap each push with the next fetch
+    RUNTIME = os.getenv('RUNTIME', 'sync').lower()
+    # asyncio runtime: Loki fetching stops this many seconds into a cycle (0: the push interval)
+    CYCLE_DEADLINE_SECONDS = int(os.getenv('CYCLE_DEADLINE_SECONDS', '0'))
+    STATE_DIR = os.getenv('STATE_DIR', 'state')
+    CURSOR_FILE = os.path.join(STATE_DIR, 'cursor.json')
+
+    # Checkpoint Configuration
+    # The full metrics state and ingest cursor are snapshotted every
+    # CHECKPOINT_INTERVAL_SECONDS (0 disables) and restored on startup
+    CHECKPOINT_INTERVAL_SECONDS = int(os.getenv('CHECKPOINT_INTERVAL_SECONDS', '300'))
+    CHECKPOINT_FILE = os.path.join(STATE_DIR, 'checkpoint.json')
+
+    # Loki query; the body JSON is cut out of the line and decoded by the reader.
+    # Only line filters belong here: a parser stage (`| json`, `| regexp`) adds
+    # per-line labels, which turns every line into its own Loki stream
+    LOKI_QUERY = os.getenv('LOKI_QUERY', r'''{app="otel-collector"} |~ `Body: Map\(`''')
+    # Stages that extract the body on Loki for the LogQL metric queries, whose
+    # per-line labels are aggregated away
+    LOKI_BODY_STAGES = os.getenv(
+        'LOKI_BODY_STAGES', r'''| regexp `Body: Map\((?P<body>\{.*\})\)` | line_format "{{.body}}"'''
+    )
+
+    # Aggregation pushdown: flows and errors are counted by LogQL metric queries
+    # on Loki, and only the status-changing lines (types 1, 3, 15) are fetched raw
+    AGGREGATION_PUSHDOWN = os.getenv('AGGREGATION_PUSHDOWN', 'false').lower() == 'true'
+
+    # Sharding: with SHARDS > 1 (window and cursor mode) each of SHARDS worker
+    # processes ingests the projects with crc32(projectkey) % SHARDS == its index
+    SHARDS = int(os.getenv('SHARDS', '1'))
+
+    # Replay: historical ranges are fetched in chunks of this many minutes, MAX_WORKERS at a time
+    REPLAY_CHUNK_MINUTES = int(os.getenv('REPLAY_CHUNK_MINUTES', '15'))
+    LOKI_STATUS_QUERY = os.getenv('LOKI_STATUS_QUERY', LOKI_QUERY + r' |~ `"messagetypeid":\s*(1|3|15)\b`')
 
     @staticmethod
     def setup_logging():
@@ -59,12 +187,16 @@ class Config:
         
         # Remove any existing handlers
         root_logger.handlers = []
+        if Config._log_listener is not None:
+            Config._log_listener.stop()
+            Config._log_listener = None
+        handlers = []
         
         # Add console handler only if enabled
         if Config.ENABLE_CONSOLE_LOG:
             console_handler = logging.StreamHandler()
             console_handler.setFormatter(formatter)
-            root_logger.addHandler(console_handler)
+            handlers.append(console_handler)
         
         # Create file handlers for different log levels
         info_handler = RotatingFileHandler(
@@ -92,12 +224,50 @@ class Config:
         debug_handler.setFormatter(formatter)
         
         # Add file handlers
-        root_logger.addHandler(info_handler)
-        root_logger.addHandler(error_handler)
-        root_logger.addHandler(debug_handler)
+        handlers.extend((info_handler, error_handler, debug_handler))
+
+        if not Config.LOG_ASYNC:
+            for handler in handlers:
+                root_logger.addHandler(handler)
+            return
+
+        # The logging thread only enqueues; the listener thread formats and writes
+        log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+        root_logger.addHandler(DroppingQueueHandler(log_queue))
+        Config._log_listener = LogWriter(log_queue, *handlers, respect_handler_level=True)
+        Config._log_listener.start()
+
+    @staticmethod
+    def stop_logging():
+        """Write out the queued log records and stop the background writer"""
+        if Config._log_listener is not None:
+            Config._log_listener.stop()
+            Config._log_listener = None
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records rather than block when the queue is full"""
+
+    def prepare(self, record):
+        # The queue stays in this process, so records need not be made picklable;
+        # message and traceback formatting is left to the writer thread's handlers
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+class LogWriter(QueueListener):
+    """Background writer of the queued log records"""
+
+    def enqueue_sentinel(self):
+        # Wait for room rather than fail on a full queue; the records before it are still written
+        self.queue.put(self._sentinel)
 
 # Setup logging
 Config.setup_logging()
+atexit.register(Config.stop_logging)
 logger = logging.getLogger(__name__)
 
 # Global registry for Prometheus
@@ -115,6 +285,13 @@ class StatusMapping:
     STOPPED = 2
     ERROR = 3
     UNRESPONSIVE = 4
+
+    NAMES = {
+        RUNNING: ServerStatus.RUNNING,
+        STOPPED: ServerStatus.STOPPED,
+        ERROR: ServerStatus.ERROR,
+        UNRESPONSIVE: ServerStatus.UNRESPONSIVE
+    }
     
     @staticmethod
     def get_numeric_status(status_text):
@@ -126,45 +303,468 @@ class StatusMapping:
         }
         return status_map.get(status_text, 0)
 
-# Create gauges for each KPI (copied from otel.py)
+    @staticmethod
+    def get_status_text(numeric_status):
+        return StatusMapping.NAMES.get(numeric_status)
+
+# KPI definitions (copied from otel.py): name -> (description, labels)
+METRIC_DEFINITIONS = {
+    'project_name': ('Name of the Project', ['serverid', 'projectkey']),
+    'current_session_start': ('Current Session Start Time', ['serverid', 'projectkey']),
+    'latest_transaction_time': ('Latest Transaction Time', ['serverid', 'projectkey']),
+    'uptime_current_session_ns': ('Uptime of Current Session in Nanoseconds', ['serverid', 'projectkey']),
+    'uptime_current_session_sec': ('Uptime of Current Session in Seconds', ['serverid', 'projectkey']),
+    'total_errors_current_session': ('Total Errors in Current Session', ['serverid', 'projectkey']),
+    'errors_last_hour': ('Errors in Last Hour', ['serverid', 'projectkey']),
+    'total_flows_current_session': ('Total Flows Executed Current Session', ['serverid', 'projectkey']),
+    'flows_last_hour': ('Flows Executed in Last Hour', ['serverid', 'projectkey']),
+    'server_status': ('Current Server Status', ['serverid', 'projectkey', 'status']),
+    'project_status': ('Current Project Status', ['projectkey', 'status']),
+    'server_count': ('Count of Servers', ['projectkey'])
+}
+
+# Create gauges for each KPI
 SUMMARY_METRICS = {
-    'project_name': Gauge('project_name', 'Name of the Project', ['serverid', 'projectkey'], registry=REGISTRY),
-    'current_session_start': Gauge('current_session_start', 'Current Session Start Time', ['serverid', 'projectkey'], registry=REGISTRY),
-    'latest_transaction_time': Gauge('latest_transaction_time', 'Latest Transaction Time', ['serverid', 'projectkey'], registry=REGISTRY),
-    'uptime_current_session_ns': Gauge('uptime_current_session_ns', 'Uptime of Current Session in Nanoseconds', ['serverid', 'projectkey'], registry=REGISTRY),
-    'uptime_current_session_sec': Gauge('uptime_current_session_sec', 'Uptime of Current Session in Seconds', ['serverid', 'projectkey'], registry=REGISTRY),
-    'total_errors_current_session': Gauge('total_errors_current_session', 'Total Errors in Current Session', ['serverid', 'projectkey'], registry=REGISTRY),
-    'errors_last_hour': Gauge('errors_last_hour', 'Errors in Last Hour', ['serverid', 'projectkey'], registry=REGISTRY),
-    'total_flows_current_session': Gauge('total_flows_current_session', 'Total Flows Executed Current Session', ['serverid', 'projectkey'], registry=REGISTRY),
-    'flows_last_hour': Gauge('flows_last_hour', 'Flows Executed in Last Hour', ['serverid', 'projectkey'], registry=REGISTRY),
-    'server_status': Gauge('server_status', 'Current Server Status', ['serverid', 'projectkey', 'status'], registry=REGISTRY),
-    'project_status': Gauge('project_status', 'Current Project Status', ['projectkey', 'status'], registry=REGISTRY),
-    'server_count': Gauge('server_count', 'Count of Servers', ['projectkey'], registry=REGISTRY)
+    name: Gauge(name, description, labels, registry=REGISTRY)
+    for name, (description, labels) in METRIC_DEFINITIONS.items()
 }
 
-class MetricsState:
+# Series per server (server_status has one per status) and per project
+SERVER_SERIES = sum(
+    len(StatusMapping.NAMES) if 'status' in labels else 1
+    for labels in (labels for _, labels in METRIC_DEFINITIONS.values()) if 'serverid' in labels
+)
+PROJECT_SERIES = sum(
+    len(StatusMapping.NAMES) if 'status' in labels else 1
+    for labels in (labels for _, labels in METRIC_DEFINITIONS.values()) if 'serverid' not in labels
+)
+
+# Metrics about the reader itself, kept apart from the summary metrics
+READER_REGISTRY = CollectorRegistry()
+SERVERS_EVICTED = Counter('loki_reader_servers_evicted_total',
+                          'Servers whose series were removed, by reason (retention or cap)',
+                          ['reason'], registry=READER_REGISTRY)
+ACTIVE_SERIES = Gauge('loki_reader_active_series', 'Summary metric series currently tracked',
+                      registry=READER_REGISTRY)
+CYCLE_STAGE_SECONDS = Histogram(
+    'loki_reader_cycle_stage_seconds',
+    'Time per cycle spent fetching from Loki, decoding log lines, applying events to the state and pushing',
+    ['stage'], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120), registry=READER_REGISTRY
+)
+CYCLE_LINES = Histogram('loki_reader_cycle_lines', 'Log lines read from Loki per cycle',
+                        buckets=(0, 100, 1000, 10000, 50000, 100000, 500000, 1000000, 5000000),
+                        registry=READER_REGISTRY)
+CYCLE_BYTES = Histogram('loki_reader_cycle_bytes', 'Response bytes read from Loki per cycle',
+                        buckets=(0, 1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 5e8, 1e9), registry=READER_REGISTRY)
+LINES_READ = Counter('loki_reader_lines_read_total', 'Log lines read from Loki', registry=READER_REGISTRY)
+BYTES_READ = Counter('loki_reader_bytes_read_total', 'Response bytes read from Loki', registry=READER_REGISTRY)
+LOKI_REQUEST_SECONDS = Histogram('loki_reader_loki_request_seconds', 'Loki query latency until the response starts',
+                                 ['query'], registry=READER_REGISTRY)
+TRUNCATED_RESPONSES = Counter('loki_reader_truncated_responses_total',
+                              'Loki responses cut off at the entry limit', registry=READER_REGISTRY)
+PARSE_ERRORS = Counter('loki_reader_parse_errors_total', 'Log lines that could not be decoded or processed',
+                       registry=READER_REGISTRY)
+INGEST_LAG = Gauge('loki_reader_ingest_lag_seconds', 'Time since the newest ingested event', registry=READER_REGISTRY)
+LAST_CYCLE = Gauge('loki_reader_last_cycle_timestamp_seconds', 'Time the last cycle pushed or published its metrics',
+                   registry=READER_REGISTRY)
+STATE_SIZE = Gauge('loki_reader_state_size', 'Entries held in the metrics state, by kind',
+                   ['kind'], registry=READER_REGISTRY)
+CIRCUIT_OPEN = Gauge('loki_reader_circuit_open', 'Whether the circuit to an endpoint is open',
+                     ['endpoint'], registry=READER_REGISTRY)
+LOG_RECORDS_DROPPED = Counter('loki_reader_log_records_dropped_total',
+                              'Log records dropped because the log queue was full', registry=READER_REGISTRY)
+LOG_MESSAGES_SUPPRESSED = Counter('loki_reader_log_messages_suppressed_total',
+                                  'Per-event log messages suppressed by LOG_SAMPLE_RATE',
+                                  ['message'], registry=READER_REGISTRY)
+
+class LogSampler:
+    """Rate limit for per-event log messages.
+
+    allow(kind) is true for the first `rate` messages of a kind in each second
+    (always with rate 0); the rest are counted as suppressed, and the number
+    suppressed is logged once the next second's first message of that kind
+    goes through.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._windows = {}  # kind -> [window start, messages allowed, messages suppressed]
+        self._lock = threading.Lock()
+
+    def allow(self, kind):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        suppressed = 0
+        with self._lock:
+            window = self._windows.get(kind)
+            if window is None:
+                window = self._windows[kind] = [now, 0, 0]
+            elif now - window[0] >= 1:
+                suppressed = window[2]
+                window[:] = [now, 0, 0]
+            allowed = window[1] < self.rate
+            if allowed:
+                window[1] += 1
+            else:
+                window[2] += 1
+        if suppressed:
+            logger.info(f"Suppressed {suppressed} '{kind}' log messages")
+        if not allowed:
+            LOG_MESSAGES_SUPPRESSED.labels(kind).inc()
+        return allowed
+
+event_log_sampler = LogSampler(Config.LOG_SAMPLE_RATE)
+
+class SlidingWindowCounter:
+    """Event counts over a trailing time window, kept in a fixed ring of buckets.
+
+    The ring holds one or more channels (e.g. errors and flows), bucket i of
+    channel c at i * channels + c. Adding and counting are O(1) amortized and
+    memory is constant: expired buckets are cleared as the window slides
+    forward. The ring is allocated on the first event so idle counters stay
+    small, with 8-bit buckets that are widened once one overflows.
+    """
+    __slots__ = ('resolution', 'size', 'channels', 'buckets', 'head', 'totals')
+    TYPECODES = ('B', 'H', 'I', 'Q')
+
+    def __init__(self, window_ns, resolution_ns, channels=1):
+        self.resolution = resolution_ns
+        self.size = max(1, -(-window_ns // resolution_ns))
+        self.channels = channels
+        self.buckets = None
+        self.head = 0  # bucket index (timestamp // resolution) of the newest bucket
+        self.totals = None
+
+    def _clear(self, typecode):
+        self.buckets = array(typecode, [0]) * (self.size * self.channels)
+        self.totals = [0] * self.channels
+
+    def _advance(self, index):
+        if index <= self.head:
+            return
+        if index - self.head >= self.size:
+            self._clear(self.buckets.typecode)
+        else:
+            channels = self.channels
+            for i in range(self.head + 1, index + 1):
+                base = i % self.size * channels
+                for channel in range(channels):
+                    self.totals[channel] -= self.buckets[base + channel]
+                    self.buckets[base + channel] = 0
+        self.head = index
+
+    def add(self, timestamp, count=1, channel=0):
+        """Count events of a channel at timestamp (ns)"""
+        index = timestamp // self.resolution
+        if self.buckets is None:
+            self._clear(self.TYPECODES[0])
+            self.head = index
+        self._advance(index)
+        if index <= self.head - self.size:
+            return  # older than the window
+        slot = index % self.size * self.channels + channel
+        while True:
+            try:
+                self.buckets[slot] += count
+                break
+            except OverflowError:
+                typecode = self.TYPECODES[self.TYPECODES.index(self.buckets.typecode) + 1]
+                self.buckets = array(typecode, self.buckets)
+        self.totals[channel] += count
+
+    def reset(self):
+        """Forget all counted events"""
+        self.buckets = None
+        self.totals = None
+
+    def count(self, timestamp, channel=0):
+        """Number of events of a channel in the window ending at timestamp (ns)"""
+        if self.buckets is None:
+            return 0
+        self._advance(timestamp // self.resolution)
+        return self.totals[channel]
+
+    def to_state(self, channel=0):
+        """Serializable [resolution, head, base64 32-bit buckets] of a channel, or None if the ring was never used"""
+        if self.buckets is None:
+            return None
+        buckets = array('I', self.buckets[channel::self.channels])
+        return [self.resolution, self.head, base64.b64encode(buckets.tobytes()).decode('ascii')]
+
+    def load_state(self, state, channel=0):
+        """Restore a channel from to_state(); a ring of another resolution or size is dropped"""
+        if state is None:
+            return
+        resolution, head, encoded = state
+        buckets = array('I')
+        buckets.frombytes(base64.b64decode(encoded))
+        if resolution != self.resolution or len(buckets) != self.size:
+            return
+        for index in range(head - self.size + 1, head + 1):
+            if buckets[index % self.size]:
+                self.add(index * resolution, buckets[index % self.size], channel)
+
+class EventDeduplicator:
+    """Idempotent event admission for overlapping queries, retries and replays.
+
+    The watermark trails the newest event time by the lateness tolerance;
+    older events are dropped as late. Events at or past the watermark are
+    checked against an index of the (stream, timestamp, line) keys seen so
+    far, so distinct events sharing a timestamp are all kept. Keys fall out
+    of the index as the watermark passes them. If the index still reaches
+    its capacity the oldest key is evicted and the watermark raised past it,
+    so memory stays bounded without ever counting an event twice.
+    """
+
+    def __init__(self, lateness_ns, capacity):
+        self.lateness = lateness_ns
+        self.capacity = capacity
+        self.max_timestamp = 0
+        self.floor = 0  # raised past evicted keys
+        self.index = OrderedDict()  # event key -> timestamp, in arrival order
+
+    @staticmethod
+    def event_key(stream, timestamp, line):
+        """Compact key of an event: a hash of (stream hash, timestamp, line hash)"""
+        return hash((zlib.crc32(stream.encode()), timestamp, zlib.crc32(line.encode())))
+
+    @property
+    def watermark(self):
+        return max(self.max_timestamp - self.lateness, self.floor)
+
+    def seen(self, key, timestamp, accept_late=False):
+        """Return True if the event is late or already seen, otherwise record it.
+        With accept_late, late events count as new but are not recorded; only for
+        events that cannot have been applied before."""
+        if key in self.index:
+            return True
+        if timestamp < self.watermark:
+            return not accept_late
+
+        self.index[key] = timestamp
+        if timestamp > self.max_timestamp:
+            self.max_timestamp = timestamp
+            self._expire()
+        if len(self.index) > self.capacity:
+            _, evicted = self.index.popitem(last=False)
+            self.floor = max(self.floor, evicted + 1)
+        return False
+
+    def _expire(self):
+        """Drop keys from the front of the index that are behind the watermark"""
+        watermark = self.watermark
+        index = self.index
+        while index:
+            key = next(iter(index))
+            if index[key] >= watermark:
+                break
+            del index[key]
+
+    def to_state(self):
+        return {
+            'max_timestamp': self.max_timestamp,
+            'floor': self.floor,
+            'index': list(self.index.items()),
+        }
+
+    def load_state(self, state):
+        self.max_timestamp = state.get('max_timestamp', 0)
+        self.floor = state.get('floor', 0)
+        self.index = OrderedDict((key, timestamp) for key, timestamp in state.get('index', []))
+
+class DeadlineScheduler:
+    """Min-heap of per-server deadlines.
+
+    Each server has at most one live deadline. Arming a server that already
+    has an earlier or equal deadline is an O(1) no-op, so callers can arm on
+    every event; arming an earlier deadline supersedes the pending one, whose
+    heap entry is skipped when it surfaces. When a deadline fires, the caller
+    decides whether it still applies or arms a new one.
+    """
+
     def __init__(self):
-        self.server_sessions = defaultdict(dict)
+        self._heap = []
+        self._deadlines = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def arm(self, server_id, deadline):
+        """Schedule a deadline unless an earlier one is already pending"""
+        current = self._deadlines.get(server_id)
+        if current is not None and current <= deadline:
+            return
+        self._deadlines[server_id] = deadline
+        heapq.heappush(self._heap, (deadline, server_id))
+
+    def cancel(self, server_id):
+        """Drop a server's pending deadline; its heap entry is skipped when it surfaces"""
+        self._deadlines.pop(server_id, None)
+
+    def pop_due(self, now):
+        """Yield server_id for every deadline that has passed"""
+        while self._heap and self._heap[0][0] < now:
+            deadline, server_id = heapq.heappop(self._heap)
+            if self._deadlines.get(server_id) != deadline:
+                continue  # superseded by an earlier deadline
+            del self._deadlines[server_id]
+            yield server_id
+
+class EventClock:
+    """Event-time clock: reads as the newest timestamp it has been advanced to.
+
+    A replay drives MetricsState with it instead of the wall clock, so the
+    unresponsive, reset and error timeouts fire relative to the log stream.
+    """
+
+    def __init__(self, now_ns=0):
+        self.now_ns = now_ns
+
+    def advance(self, timestamp):
+        if timestamp > self.now_ns:
+            self.now_ns = timestamp
+
+    def __call__(self):
+        return self.now_ns
+
+class ServerSession:
+    """Compact per-server session record; status is a StatusMapping integer"""
+    __slots__ = ('server_id', 'project_key', 'session_start', 'last_seen', 'status',
+                 'error_count', 'flow_count', 'error_time', 'stopped_at', 'window')
+    # Channels of the last-hour window
+    ERRORS = 0
+    FLOWS = 1
+
+    def __init__(self, server_id, project_key, timestamp):
+        resolution_ns = Config.WINDOW_BUCKET_SECONDS * 1_000_000_000
+        self.server_id = server_id
+        self.project_key = project_key
+        self.session_start = timestamp
+        self.last_seen = timestamp
+        self.status = StatusMapping.RUNNING
+        self.error_count = 0
+        self.flow_count = 0
+        self.error_time = 0  # time the current ERROR status was entered, 0 if none
+        self.stopped_at = 0  # time the server was last marked STOPPED, 0 if never
+        # Last-hour error and flow counts, in one ring
+        self.window = SlidingWindowCounter(MetricsState.HOUR_NS, resolution_ns, channels=2)
+
+    def to_state(self):
+        """Serializable record of the session, see from_state()"""
+        return [self.server_id, self.project_key, self.session_start, self.last_seen, self.status,
+                self.error_count, self.flow_count, self.error_time,
+                self.window.to_state(self.ERRORS), self.window.to_state(self.FLOWS), self.stopped_at]
+
+    @classmethod
+    def from_state(cls, state):
+        (server_id, project_key, session_start, last_seen, status,
+         error_count, flow_count, error_time, errors, flows) = state[:10]
+        session = cls(sys.intern(server_id), sys.intern(project_key), session_start)
+        session.last_seen = last_seen
+        session.status = status
+        session.error_count = error_count
+        session.flow_count = flow_count
+        session.error_time = error_time
+        # Checkpoints written before stopped_at was recorded count from the last event
+        session.stopped_at = state[10] if len(state) > 10 else (last_seen if status == StatusMapping.STOPPED else 0)
+        session.window.load_state(errors, cls.ERRORS)
+        session.window.load_state(flows, cls.FLOWS)
+        return session
+
+class MetricsState:
+    HOUR_NS = 60 * 60 * 1_000_000_000
+
+    def __init__(self, clock=None):
+        # Current time in ns for the timeouts: the wall clock, or an EventClock in a replay
+        self.clock = clock or time.time_ns
+        # Set while a gap is caught up on event time, see begin_catch_up()
+        self.catch_up_clock = None
+        self._live_clock = self.clock
+        # server_id -> ServerSession; project_servers shares the same records
+        self.server_sessions = {}
         self.project_servers = defaultdict(dict)
-        self.server_history = defaultdict(list)
-        self.error_timestamps = {}
+        self.deadlines = DeadlineScheduler()
         self.last_project_status = {}
-        self.last_processed_timestamp = 0  # Track last processed timestamp to avoid duplicates
+        self.dedup = EventDeduplicator(Config.DEDUP_LATENESS_SECONDS * 1_000_000_000, Config.DEDUP_CAPACITY)
         self.project_primary_hosts = {}
+        # Series touched since the last flush to the registry
+        self.batching = False
+        # Set while applying a catch-up of lines no query returned before (see EventDeduplicator.seen)
+        self.accept_late = False
+        self.dirty_servers = set()
+        self.dirty_projects = set()
+        # Gauges are only needed when metrics are pushed from REGISTRY
+        self.write_gauges = Config.METRICS_SINK != 'http' and Config.PUSH_MODE == 'full'
+        # Projects changed since the last grouped push
+        self.track_pushes = Config.METRICS_SINK != 'http' and Config.PUSH_MODE == 'grouped'
+        self.unpushed_projects = set()
+        # With aggregation pushdown flows and errors are counted by Loki (see
+        # apply_counts) up to counted_until, not from individual events
+        self.count_events = not (Config.AGGREGATION_PUSHDOWN and Config.INGEST_MODE != 'otlp')
+        self.counted_until = 0
+
+    def snapshot(self):
+        """Serializable copy of everything needed to resume, see restore()"""
+        return {
+            'dedup': self.dedup.to_state(),
+            'counted_until': self.counted_until,
+            'last_project_status': self.last_project_status,
+            'sessions': [session.to_state() for session in self.server_sessions.values()],
+        }
+
+    def restore(self, snapshot):
+        """Replace the state with a snapshot, re-arm deadlines and rewrite every series"""
+        self.server_sessions = {}
+        self.project_servers = defaultdict(dict)
+        self.deadlines = DeadlineScheduler()
+        self.dedup.load_state(snapshot.get('dedup', {}))
+        self.counted_until = snapshot.get('counted_until', 0)
+        self.last_project_status = dict(snapshot.get('last_project_status', {}))
+
+        for state in snapshot.get('sessions', []):
+            session = ServerSession.from_state(state)
+            self.server_sessions[session.server_id] = session
+            self.project_servers[session.project_key][session.server_id] = session
+            if session.status != StatusMapping.STOPPED:
+                self._arm_deadlines(session)
+            else:
+                self._arm_retention(session)
+            self._mark_dirty(session)
+
+        # The timeouts wait for the gap since the snapshot to be caught up
+        self.flush()
+        return len(self.server_sessions)
+
+    def begin_catch_up(self, start_ns):
+        """Run the timeouts on event time, from start_ns on, while a gap of old
+        events is applied; on the wall clock they would mark every server that was
+        active during the gap unresponsive"""
+        self._live_clock = self.clock
+        self.catch_up_clock = EventClock(start_ns)
+        self.clock = self.catch_up_clock
+
+    def end_catch_up(self):
+        """Switch back to the live clock once the gap has been applied, and apply
+        the timeouts of the servers that went silent since"""
+        if self.catch_up_clock is None:
+            return
+        self.catch_up_clock = None
+        self.clock = self._live_clock
+        self.check_timeouts()
 
     def get_earliest_active_server_start_time(self, project_key):
         """Get the earliest start time among active servers for a project"""
         try:
             logger.debug(f"Getting earliest active server start time for project {project_key}")
-            active_servers = {
-                server_id: details 
-                for server_id, details in self.project_servers[project_key].items()
-                if details.get('status') == ServerStatus.RUNNING
-            }
+            active_servers = [
+                session for session in self.project_servers.get(project_key, {}).values()
+                if session.status == StatusMapping.RUNNING
+            ]
             if not active_servers:
                 logger.info(f"No active servers found for project {project_key}")
                 return None
-            earliest_time = min(details['start_time'] for details in active_servers.values())
+            earliest_time = min(session.session_start for session in active_servers)
             logger.debug(f"Earliest start time for project {project_key}: {earliest_time}")
             return earliest_time
         except Exception as e:
@@ -172,427 +772,2452 @@ class MetricsState:
             logger.debug(f"Stack trace: {traceback.format_exc()}")
             return None
 
-    def update_metrics(self, server_id, project_key, msg_type, timestamp):
-        """Update metrics based on the log entry"""
+    def update_metrics(self, server_id, project_key, msg_type, timestamp, event_key=None):
+        """Update metrics based on the log entry.
+
+        event_key identifies the entry for deduplication (see
+        EventDeduplicator.event_key); without one it is derived from the event.
+        """
         try:
-            logger.debug(f"Updating metrics for server_id={server_id}, project_key={project_key}, msg_type={msg_type}, timestamp={timestamp}")
-            # Skip if we've already processed this timestamp
-            if timestamp <= self.last_processed_timestamp:
-                logger.debug(f"Skipping update for timestamp {timestamp} as it's already processed")
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug and event_log_sampler.allow('update'):
+                logger.debug(f"Updating metrics for server_id={server_id}, project_key={project_key}, msg_type={msg_type}, timestamp={timestamp}")
+            # Skip late entries and entries that have already been processed
+            if event_key is None:
+                event_key = EventDeduplicator.event_key('', timestamp, f"{server_id}/{project_key}/{msg_type}")
+            if self.dedup.seen(event_key, timestamp, self.accept_late):
+                if debug and event_log_sampler.allow('duplicate'):
+                    logger.debug(f"Skipping update for timestamp {timestamp} as it's already processed or late")
                 return
+            if self.catch_up_clock is not None:
+                # Servers that went silent during the gap time out when they would have live
+                self.catch_up_clock.advance(timestamp)
+                self._check_unresponsive_servers()
+
+            # Label values are strings; intern them so every record shares one copy
+            server_id = sys.intern(str(server_id))
+            project_key = sys.intern(str(project_key))
             
             # Initialize server session if it doesn't exist
-            if server_id not in self.server_sessions:
-                self.update_server_start(server_id, project_key, timestamp)
+            session = self.server_sessions.get(server_id)
+            if session is None:
+                session = self.update_server_start(server_id, project_key, timestamp)
 
-            session = self.server_sessions[server_id]
-            session['last_seen'] = timestamp
-            
-            # Update latest transaction time
-            SUMMARY_METRICS['latest_transaction_time'].labels(serverid=server_id, projectkey=project_key).set(timestamp)
+            # Late entries do not move last_seen back
+            session.last_seen = max(session.last_seen, timestamp)
+            self._arm_deadlines(session)
             
             # Update metrics based on message type
             message_handled = False
-            current_time = time.time_ns()
+            current_time = self.clock()
             
             if msg_type == 15:  # Error message
-                session['error_count'] += 1
-                self.server_history[server_id].append({'type': 'error', 'time': timestamp})
-                self._update_server_status(server_id, project_key, ServerStatus.ERROR)
-                self.error_timestamps[server_id] = current_time
+                if self.count_events:
+                    session.error_count += 1
+                    session.window.add(timestamp, 1, session.ERRORS)
+                self._update_server_status(session, StatusMapping.ERROR)
+                session.error_time = current_time
                 message_handled = True
             elif msg_type == 5:  # Flow completed
-                session['flow_count'] += 1
-                self.server_history[server_id].append({'type': 'flow', 'time': timestamp})
+                session.flow_count += 1
+                session.window.add(timestamp, 1, session.FLOWS)
                 message_handled = True
             elif msg_type == 3:  # Server Stop
-                self._update_server_status(server_id, project_key, ServerStatus.STOPPED)
-                if server_id in self.error_timestamps:
-                    del self.error_timestamps[server_id]
+                self._update_server_status(session, StatusMapping.STOPPED)
+                session.error_time = 0
                 message_handled = True
             elif msg_type == 1:  # Server Start
-                self.update_server_start(server_id, project_key, timestamp)
-                if server_id in self.error_timestamps:
-                    del self.error_timestamps[server_id]
+                session = self.update_server_start(server_id, project_key, timestamp)
                 message_handled = True
             
-            if not message_handled:
+            if not message_handled and event_log_sampler.allow('unknown_type'):
                 logger.warning("Received message type %d from server %s, project %s", 
                              msg_type, server_id, project_key)
             
             # Check if server should still be in ERROR state
-            if session.get('status') == ServerStatus.ERROR:
-                error_time = self.error_timestamps.get(server_id, 0)
-                if current_time - error_time > (Config.ERROR_TIMEOUT_HOURS * 60 * 60 * 1000000000):
+            if session.status == StatusMapping.ERROR:
+                if current_time - session.error_time > (Config.ERROR_TIMEOUT_HOURS * 60 * 60 * 1000000000):
                     logger.info("Server %s error timeout expired after %s hours, updating to RUNNING", 
                               server_id, Config.ERROR_TIMEOUT_HOURS)
-                    self._update_server_status(server_id, project_key, ServerStatus.RUNNING)
-                    if server_id in self.error_timestamps:
-                        del self.error_timestamps[server_id]
+                    self._update_server_status(session, StatusMapping.RUNNING)
+                    session.error_time = 0
 
-            # Update session metrics
-            self._update_session_metrics(server_id, project_key, timestamp)
+            # Session metrics are written on the next flush
+            self._mark_dirty(session)
             
             # Check for unresponsive servers
             self._check_unresponsive_servers()
-            
-            # Update last processed timestamp
-            self.last_processed_timestamp = timestamp
 
         except Exception as e:
-            logger.error(f"Error updating metrics: {e}")
+            if event_log_sampler.allow('update_error'):
+                logger.error(f"Error updating metrics: {e}")
+                logger.error(traceback.format_exc())
+
+        if not self.batching:
+            self.flush()
+
+    def apply_batch(self, events, accept_late=False):
+        """Apply (server_id, project_key, msg_type, timestamp[, event_key]) events and
+        write each touched series to the registry once, after the whole batch"""
+        count = 0
+        self.batching = True
+        self.accept_late = accept_late
+        try:
+            for event in events:
+                self.update_metrics(*event)
+                count += 1
+        finally:
+            self.batching = False
+            self.accept_late = False
+            self.flush()
+        return count
+
+    def apply_counts(self, samples):
+        """Apply (server_id, project_key, msg_type, bucket_end, count) samples from
+        a LogQL count_over_time query, in bucket order.
+
+        Flow and error counts are added to the session totals and last-hour
+        counters; any message counts as activity, with last_seen at the bucket end.
+        Buckets that ended before the current session started are skipped.
+        """
+        count = 0
+        self.batching = True
+        try:
+            for server_id, project_key, msg_type, timestamp, bucket_count in samples:
+                server_id = sys.intern(str(server_id))
+                session = self.server_sessions.get(server_id)
+                if session is None:
+                    session = self.update_server_start(server_id, sys.intern(str(project_key)), timestamp)
+                elif timestamp <= session.session_start:
+                    continue
+
+                # The bucket covers (timestamp - step, timestamp]
+                if msg_type == 15:
+                    session.error_count += bucket_count
+                    session.window.add(timestamp - 1, bucket_count, session.ERRORS)
+                elif msg_type == 5:
+                    session.flow_count += bucket_count
+                    session.window.add(timestamp - 1, bucket_count, session.FLOWS)
+
+                if timestamp > session.last_seen:
+                    session.last_seen = timestamp
+                    self._arm_deadlines(session)
+                self._mark_dirty(session)
+                count += 1
+
+            self._check_unresponsive_servers()
+        except Exception as e:
+            logger.error(f"Error applying message counts: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            self.batching = False
+            self.flush()
+        return count
+
+    def _mark_dirty(self, session):
+        """Queue a server's series (and its project's) for the next flush"""
+        self.dirty_servers.add(session.server_id)
+        self.dirty_projects.add(session.project_key)
+
+    def flush(self):
+        """Write the series of every server and project changed since the last flush.
+        Without a Pushgateway sink only project status transitions are logged."""
+        self._enforce_series_cap()
+        if self.write_gauges:
+            for server_id in self.dirty_servers:
+                self._flush_server(server_id)
+        for project_key in self.dirty_projects:
+            self._update_project_status(project_key)
+        if self.track_pushes:
+            self.unpushed_projects |= self.dirty_projects
+        self.dirty_servers.clear()
+        self.dirty_projects.clear()
+        ACTIVE_SERIES.set(self.series_count())
+
+    def _flush_server(self, server_id):
+        """Write all per-server gauges from the session state"""
+        try:
+            for name, labels, value in self.server_samples(server_id):
+                SUMMARY_METRICS[name].labels(**labels).set(value)
+        except Exception as e:
+            logger.error(f"Error updating session metrics: {e}")
             logger.error(traceback.format_exc())
 
+    def server_samples(self, server_id):
+        """Yield (metric name, labels, value) for every per-server series"""
+        session = self.server_sessions.get(server_id)
+        if session is None:
+            return
+        last_seen = session.last_seen
+        labels = {'serverid': server_id, 'projectkey': session.project_key}
+
+        yield 'project_name', labels, 1
+        yield 'current_session_start', labels, session.session_start
+        yield 'latest_transaction_time', labels, last_seen
+        yield 'total_errors_current_session', labels, session.error_count
+        yield 'total_flows_current_session', labels, session.flow_count
+
+        # Calculate last hour metrics
+        yield 'errors_last_hour', labels, session.window.count(last_seen, session.ERRORS)
+        yield 'flows_last_hour', labels, session.window.count(last_seen, session.FLOWS)
+
+        # Update uptime; a reset session starts after its last event, so clamp at 0
+        uptime_ns = max(0, last_seen - session.session_start)
+        yield 'uptime_current_session_ns', labels, uptime_ns
+        yield 'uptime_current_session_sec', labels, uptime_ns / 1_000_000_000
+
+        # All status values are 0 except the current status
+        for status, name in StatusMapping.NAMES.items():
+            yield 'server_status', dict(labels, status=name), status if status == session.status else 0
+
+    @staticmethod
+    def _label_values(samples):
+        """Convert (name, labels, value) samples to (name, label values, value)"""
+        for name, labels, value in samples:
+            yield name, [str(labels[label]) for label in METRIC_DEFINITIONS[name][1]], value
+
+    def iter_samples(self):
+        """Yield (metric name, label values, value) for every series, with the
+        label values in METRIC_DEFINITIONS order"""
+        for server_id in list(self.server_sessions):
+            yield from self._label_values(self.server_samples(server_id))
+        for project_key in list(self.project_servers):
+            yield from self._label_values(self.project_samples(project_key))
+
+    def project_group_samples(self, project_key):
+        """Yield (metric name, label values, value) for every series of one project:
+        its servers' series and the project's own"""
+        for server_id in list(self.project_servers.get(project_key, ())):
+            yield from self._label_values(self.server_samples(server_id))
+        yield from self._label_values(self.project_samples(project_key))
+
+    def take_unpushed(self):
+        """Samples of every project changed since the last call, by project key;
+        a project without servers maps to an empty list"""
+        groups = {project_key: list(self.project_group_samples(project_key))
+                  for project_key in self.unpushed_projects}
+        self.unpushed_projects = set()
+        return groups
+
+    def project_samples(self, project_key):
+        """Yield (metric name, labels, value) for every per-project series"""
+        project_status, _ = self._project_status(project_key)
+        if project_status is None:
+            return
+        for status, name in StatusMapping.NAMES.items():
+            yield 'project_status', {'projectkey': project_key, 'status': name}, status if status == project_status else 0
+        yield 'server_count', {'projectkey': project_key}, len(self.project_servers.get(project_key, ()))
+
     def update_server_start(self, server_id, project_key, timestamp):
-        """Handle server start event"""
+        """Handle server start event, returning the new session"""
         try:
-            self.server_sessions[server_id] = {
-                'session_start': timestamp,
-                'project_key': project_key,
-                'status': ServerStatus.RUNNING,
-                'error_count': 0,
-                'flow_count': 0,
-                'last_seen': timestamp
-            }
-            
-            self.project_servers[project_key][server_id] = {
-                'start_time': timestamp,
-                'status': ServerStatus.RUNNING,
-                'last_seen': timestamp
-            }
+            previous = self.server_sessions.get(server_id)
+            if previous is not None and previous.project_key != project_key:
+                # The server moved to another project
+                self.project_servers[previous.project_key].pop(server_id, None)
+                self.dirty_projects.add(previous.project_key)
 
-            # Initialize metrics
-            SUMMARY_METRICS['project_name'].labels(serverid=server_id, projectkey=project_key).set(1)
-            SUMMARY_METRICS['current_session_start'].labels(serverid=server_id, projectkey=project_key).set(timestamp)
-            SUMMARY_METRICS['latest_transaction_time'].labels(serverid=server_id, projectkey=project_key).set(timestamp)
-            
-            self._update_server_status(server_id, project_key, ServerStatus.RUNNING)
-            SUMMARY_METRICS['server_count'].labels(projectkey=project_key).set(len(self.project_servers[project_key]))
+            session = ServerSession(server_id, project_key, timestamp)
+            if previous is not None:
+                session.status = previous.status
+            self.server_sessions[server_id] = session
+            self.project_servers[project_key][server_id] = session
+
+            self._update_server_status(session, StatusMapping.RUNNING)
+            self._mark_dirty(session)
+            return session
 
         except Exception as e:
             logger.error(f"Error updating server start: {e}")
             logger.error(traceback.format_exc())
+            return self.server_sessions.get(server_id)
 
-    def _update_server_status(self, server_id, project_key, status):
+    def _update_server_status(self, session, status):
         """Update server status and related metrics"""
         try:
-            if server_id in self.server_sessions:
-                old_status = self.server_sessions[server_id]['status']
-                self.server_sessions[server_id]['status'] = status
-                self.project_servers[project_key][server_id]['status'] = status
-
-                # Log status transition
-                if old_status != status:
-                    logger.info("Server %s (Project: %s) status changed from %s to %s", 
-                              server_id, project_key, old_status, status)
-
-                # Reset all status values to 0 first
-                for s in [ServerStatus.RUNNING, ServerStatus.STOPPED, ServerStatus.ERROR, ServerStatus.UNRESPONSIVE]:
-                    SUMMARY_METRICS['server_status'].labels(serverid=server_id, projectkey=project_key, status=s).set(0)
-                
-                # Set the current status
-                numeric_status = StatusMapping.get_numeric_status(status)
-                SUMMARY_METRICS['server_status'].labels(serverid=server_id, projectkey=project_key, status=status).set(numeric_status)
+            old_status = session.status
+            session.status = status
+            if status == StatusMapping.STOPPED and old_status != StatusMapping.STOPPED:
+                session.stopped_at = self.clock()
+                self._arm_retention(session)
+
+            # Log status transition
+            if old_status != status:
+                logger.info("Server %s (Project: %s) status changed from %s to %s", 
+                          session.server_id, session.project_key,
+                          StatusMapping.get_status_text(old_status), StatusMapping.get_status_text(status))
 
-                self._update_project_status(project_key)
+            self._mark_dirty(session)
 
         except Exception as e:
             logger.error(f"Error updating server status: {e}")
             logger.error(traceback.format_exc())
 
+    def check_timeouts(self):
+        """Apply unresponsive/stopped timeouts without waiting for a new event"""
+        self._check_unresponsive_servers()
+        if not self.batching:
+            self.flush()
+
+    def _arm_deadlines(self, session):
+        """Make sure the server has its unresponsive deadline scheduled"""
+        self.deadlines.arm(session.server_id, session.last_seen + self._unresponsive_timeout_ns())
+
+    def _arm_retention(self, session):
+        """Schedule the removal of a stopped server's series"""
+        if Config.SERIES_RETENTION_HOURS > 0:
+            self.deadlines.arm(session.server_id, self._retention_deadline(session))
+
+    @staticmethod
+    def _retention_deadline(session):
+        """A stopped server is kept until it has been both stopped and silent for the retention period"""
+        return max(session.stopped_at, session.last_seen) + Config.SERIES_RETENTION_HOURS * 60 * 60 * 1_000_000_000
+
+    def series_count(self):
+        return len(self.server_sessions) * SERVER_SERIES + len(self.project_servers) * PROJECT_SERIES
+
+    def state_sizes(self):
+        """Number of entries held per kind of state"""
+        return {
+            'servers': len(self.server_sessions),
+            'projects': len(self.project_servers),
+            'window_buckets': sum(
+                len(session.window.buckets) for session in self.server_sessions.values()
+                if session.window.buckets is not None
+            ),
+            'dedup_keys': len(self.dedup.index),
+            'deadlines': len(self.deadlines),
+        }
+
+    def remove_server(self, server_id, reason):
+        """Forget a server: drop its session and remove its gauge children.
+        Its project is flushed next, and removed too if it has no servers left."""
+        session = self.server_sessions.get(server_id)
+        if session is None:
+            return
+        if self.write_gauges:
+            for name, labels, _ in self.server_samples(server_id):
+                self._remove_series(name, labels)
+        del self.server_sessions[server_id]
+        servers = self.project_servers.get(session.project_key)
+        if servers is not None:
+            servers.pop(server_id, None)
+        self.deadlines.cancel(server_id)
+        self.dirty_servers.discard(server_id)
+        self.dirty_projects.add(session.project_key)
+        SERVERS_EVICTED.labels(reason).inc()
+
+    def _remove_project(self, project_key):
+        """Forget a project without servers and remove its gauge children"""
+        if self.write_gauges:
+            for status_name in StatusMapping.NAMES.values():
+                self._remove_series('project_status', {'projectkey': project_key, 'status': status_name})
+            self._remove_series('server_count', {'projectkey': project_key})
+        self.project_servers.pop(project_key, None)
+        self.last_project_status.pop(project_key, None)
+        self.project_primary_hosts.pop(project_key, None)
+
+    @staticmethod
+    def _remove_series(name, labels):
+        try:
+            SUMMARY_METRICS[name].remove(*(labels[label] for label in METRIC_DEFINITIONS[name][1]))
+        except KeyError:
+            pass
+
+    def _enforce_series_cap(self):
+        """Evict the least recently seen servers, stopped ones first, while over MAX_SERIES"""
+        excess = self.series_count() - Config.MAX_SERIES
+        if Config.MAX_SERIES > 0 and excess > 0:
+            evict_count = -(-excess // SERVER_SERIES)
+            victims = heapq.nsmallest(
+                evict_count, self.server_sessions.values(),
+                key=lambda session: (session.status != StatusMapping.STOPPED, session.last_seen)
+            )
+            for session in victims:
+                self.remove_server(session.server_id, 'cap')
+            logger.warning(f"Series cap of {Config.MAX_SERIES} exceeded, evicted {len(victims)} least recently seen servers")
+
+    @staticmethod
+    def _unresponsive_timeout_ns():
+        return Config.UNRESPONSIVE_TIMEOUT_MINUTES * 60 * 1_000_000_000
+
+    @staticmethod
+    def _reset_timeout_ns():
+        return Config.RESET_TIMEOUT_HOURS * 60 * 60 * 1_000_000_000
+
     def _check_unresponsive_servers(self):
-        """Mark servers as unresponsive if they haven't sent messages in the last 5 minutes"""
+        """Mark servers as unresponsive if they haven't sent messages in the last 5 minutes.
+
+        Only servers whose scheduled deadline has passed are examined. Each then
+        gets its next deadline: the unresponsive timeout while it is live, the
+        reset timeout once it is unresponsive, none once it is stopped.
+        """
         try:
-            current_time = time.time_ns()
-            timeout = Config.UNRESPONSIVE_TIMEOUT_MINUTES * 60 * 1_000_000_000
-            reset_timeout = Config.RESET_TIMEOUT_HOURS * 60 * 60 * 1_000_000_000
+            current_time = self.clock()
+            timeout = self._unresponsive_timeout_ns()
+            reset_timeout = self._reset_timeout_ns()
+
+            for server_id in self.deadlines.pop_due(current_time):
+                session = self.server_sessions.get(server_id)
+                if session is None:
+                    continue
+                if session.status == StatusMapping.STOPPED:
+                    if Config.SERIES_RETENTION_HOURS > 0 and current_time >= self._retention_deadline(session):
+                        logger.info(f"Removing series of server {server_id}, stopped for over "
+                                    f"{Config.SERIES_RETENTION_HOURS} hours")
+                        self.remove_server(server_id, 'retention')
+                    else:
+                        self._arm_retention(session)
+                    continue
 
-            for server_id, session in self.server_sessions.items():
-                time_since_last_seen = current_time - session['last_seen']
-                project_key = session['project_key']
+                time_since_last_seen = current_time - session.last_seen
                 
                 # If server hasn't sent messages for more than reset timeout
-                if time_since_last_seen > reset_timeout and session['status'] != ServerStatus.STOPPED:
+                if time_since_last_seen > reset_timeout:
                     logger.info("Server %s has been unresponsive for over %s hours, marking as STOPPED", 
                               server_id, Config.RESET_TIMEOUT_HOURS)
                     
                     # Only reset metrics if transitioning from UNRESPONSIVE to STOPPED
-                    if session['status'] == ServerStatus.UNRESPONSIVE:
-                        # Reset all metrics for this server
-                        SUMMARY_METRICS['total_errors_current_session'].labels(serverid=server_id, projectkey=project_key).set(0)
-                        SUMMARY_METRICS['total_flows_current_session'].labels(serverid=server_id, projectkey=project_key).set(0)
-                        SUMMARY_METRICS['errors_last_hour'].labels(serverid=server_id, projectkey=project_key).set(0)
-                        SUMMARY_METRICS['flows_last_hour'].labels(serverid=server_id, projectkey=project_key).set(0)
-                        SUMMARY_METRICS['uptime_current_session_ns'].labels(serverid=server_id, projectkey=project_key).set(0)
-                        SUMMARY_METRICS['uptime_current_session_sec'].labels(serverid=server_id, projectkey=project_key).set(0)
-                        
-                        # Reset session data
-                        session['error_count'] = 0
-                        session['flow_count'] = 0
-                        session['session_start'] = current_time
+                    if session.status == StatusMapping.UNRESPONSIVE:
+                        # Reset session data; the zeroed metrics are written on flush
+                        session.error_count = 0
+                        session.flow_count = 0
+                        session.session_start = current_time
                         
                         # Clear history for this server
-                        self.server_history[server_id] = []
+                        session.window.reset()
                     
                     # Update server status to STOPPED
-                    self._update_server_status(server_id, project_key, ServerStatus.STOPPED)
+                    self._update_server_status(session, StatusMapping.STOPPED)
                     
                 # Regular unresponsive check
-                elif time_since_last_seen > timeout and session['status'] not in [ServerStatus.STOPPED, ServerStatus.UNRESPONSIVE]:
+                elif session.status == StatusMapping.UNRESPONSIVE:
+                    self.deadlines.arm(server_id, session.last_seen + reset_timeout)
+                elif time_since_last_seen > timeout:
                     logger.info("Server %s has been unresponsive for over %s minutes, marking as UNRESPONSIVE", 
                               server_id, Config.UNRESPONSIVE_TIMEOUT_MINUTES)
-                    self._update_server_status(server_id, project_key, ServerStatus.UNRESPONSIVE)
+                    self._update_server_status(session, StatusMapping.UNRESPONSIVE)
+                    self.deadlines.arm(server_id, session.last_seen + reset_timeout)
+                else:
+                    self.deadlines.arm(server_id, session.last_seen + timeout)
         except Exception as e:
             logger.error(f"Error checking unresponsive servers: {e}")
             logger.error(traceback.format_exc())
 
+    def _project_status(self, project_key):
+        """Derive a project's status from its servers' statuses.
+
+        Returns (status, status counts), or (None, counts) for a project without servers.
+        """
+        servers = self.project_servers.get(project_key, {})
+        status_counts = defaultdict(int)
+        for session in servers.values():
+            status_counts[session.status] += 1
+
+        if not servers:
+            return None, status_counts
+
+        total_servers = len(servers)
+
+        # Determine project status based on the rules
+        if status_counts[StatusMapping.ERROR] > 0:
+            project_status = StatusMapping.ERROR
+        elif status_counts[StatusMapping.RUNNING] > 0:
+            project_status = StatusMapping.RUNNING
+        elif status_counts[StatusMapping.STOPPED] > 0:
+            project_status = StatusMapping.STOPPED
+        elif status_counts[StatusMapping.UNRESPONSIVE] == total_servers:
+            project_status = StatusMapping.UNRESPONSIVE
+        else:
+            project_status = StatusMapping.RUNNING
+        return project_status, status_counts
+
     def _update_project_status(self, project_key):
-        """Update project status based on servers' status"""
+        """Update project status and server count metrics based on servers' status"""
         try:
-            servers = self.project_servers[project_key]
-            if not servers:
+            project_status, status_counts = self._project_status(project_key)
+            if project_status is None:
+                self._remove_project(project_key)
                 return
 
-            # First check for unresponsive servers
-            self._check_unresponsive_servers()
-
-            status_counts = defaultdict(int)
-            for server in servers.values():
-                status_counts[server['status']] += 1
-
-            total_servers = len(servers)
-
-            # Determine project status based on the rules
-            if status_counts[ServerStatus.ERROR] > 0:
-                project_status = ServerStatus.ERROR
-            elif status_counts[ServerStatus.RUNNING] > 0:
-                project_status = ServerStatus.RUNNING
-            elif status_counts[ServerStatus.STOPPED] > 0:
-                project_status = ServerStatus.STOPPED
-            elif status_counts[ServerStatus.UNRESPONSIVE] == total_servers:
-                project_status = ServerStatus.UNRESPONSIVE
-            else:
-                project_status = ServerStatus.RUNNING
-
             # Log project status change
             old_status = self.last_project_status.get(project_key)
             if old_status != project_status:
                 logger.info("Project %s status changed from %s to %s", 
-                          project_key, old_status, project_status)
-                logger.info("Project %s server status counts: %s", 
-                          project_key, dict(status_counts))
+                          project_key, StatusMapping.get_status_text(old_status),
+                          StatusMapping.get_status_text(project_status))
+                logger.info("Project %s server status counts: %s", project_key, {
+                    StatusMapping.get_status_text(status): count for status, count in status_counts.items()
+                })
                 self.last_project_status[project_key] = project_status
 
             # Update project status metrics
-            for s in [ServerStatus.RUNNING, ServerStatus.STOPPED, ServerStatus.ERROR, ServerStatus.UNRESPONSIVE]:
-                SUMMARY_METRICS['project_status'].labels(projectkey=project_key, status=s).set(0)
-            
-            numeric_status = StatusMapping.get_numeric_status(project_status)
-            SUMMARY_METRICS['project_status'].labels(projectkey=project_key, status=project_status).set(numeric_status)
+            if self.write_gauges:
+                for name, labels, value in self.project_samples(project_key):
+                    SUMMARY_METRICS[name].labels(**labels).set(value)
 
         except Exception as e:
             logger.error(f"Error updating project status: {e}")
             logger.error(traceback.format_exc())
 
-    def _update_session_metrics(self, server_id, project_key, current_timestamp):
-        """Update session-related metrics"""
-        try:
-            session = self.server_sessions[server_id]
-            
-            # Update session metrics
-            SUMMARY_METRICS['total_errors_current_session'].labels(serverid=server_id, projectkey=project_key).set(session['error_count'])
-            SUMMARY_METRICS['total_flows_current_session'].labels(serverid=server_id, projectkey=project_key).set(session['flow_count'])
-            
-            # Calculate last hour metrics
-            hour_ago = current_timestamp - (60 * 60 * 1_000_000_000)  # Convert to nanoseconds
-            recent_events = [e for e in self.server_history[server_id] if e['time'] > hour_ago]
-            
-            errors_last_hour = sum(1 for e in recent_events if e['type'] == 'error')
-            flows_last_hour = sum(1 for e in recent_events if e['type'] == 'flow')
-            
-            SUMMARY_METRICS['errors_last_hour'].labels(serverid=server_id, projectkey=project_key).set(errors_last_hour)
-            SUMMARY_METRICS['flows_last_hour'].labels(serverid=server_id, projectkey=project_key).set(flows_last_hour)
+def metric_families(samples):
+    """Build the summary metric families from (name, label values, value) samples"""
+    families = {
+        name: GaugeMetricFamily(name, description, labels=labels)
+        for name, (description, labels) in METRIC_DEFINITIONS.items()
+    }
+    for name, label_values, value in samples:
+        families[name].add_metric(label_values, value)
+    return iter(families.values())
 
-            # Update uptime
-            uptime_ns = current_timestamp - session['session_start']
-            uptime_sec = uptime_ns / 1_000_000_000
-            
-            SUMMARY_METRICS['uptime_current_session_ns'].labels(serverid=server_id, projectkey=project_key).set(uptime_ns)
-            SUMMARY_METRICS['uptime_current_session_sec'].labels(serverid=server_id, projectkey=project_key).set(uptime_sec)
+def group_by_project(samples):
+    """Split (name, label values, value) samples into lists by projectkey"""
+    positions = {name: labels.index('projectkey') for name, (_, labels) in METRIC_DEFINITIONS.items()}
+    groups = defaultdict(list)
+    for sample in samples:
+        groups[sample[1][positions[sample[0]]]].append(sample)
+    return groups
 
-        except Exception as e:
-            logger.error(f"Error updating session metrics: {e}")
-            logger.error(traceback.format_exc())
+class SamplesCollector:
+    """Collector exposing a fixed list of (name, label values, value) samples"""
 
-class LokiLogReader:
-    def __init__(self):
-        self.loki_url = f"http://{Config.LOKI_SERVER_HOST}:{Config.LOKI_SERVER_PORT}"
-        self.query_endpoint = f"{self.loki_url}/loki/api/v1/query_range"
-        self.prometheus_url = Config.PROMETHEUS_GATEWAY
-        self.metrics_state = MetricsState()
-        logger.info(f"Initialized LokiLogReader with Loki URL: {self.loki_url}")
-        logger.info(f"Using Prometheus gateway: {self.prometheus_url}")
+    def __init__(self, samples):
+        self.samples = samples
 
-    def process_logs(self, minutes=5):
-        """
-        Query and process logs from the last N minutes
-        """
-        end_time = datetime.now(pytz.UTC)
-        start_time = end_time - timedelta(minutes=minutes)
+    def describe(self):
+        return []
 
-        query = r'''{app="otel-collector"} |~ `Body: Map\(` | regexp `Body: Map\((?P<body>\{.*\})\)` | line_format "{{.body}}" | json'''
-        logger.debug(f"Querying logs from {start_time} to {end_time}")
+    def collect(self):
+        return (family for family in metric_families(self.samples) if family.samples)
 
-        logs = self.get_logs(query, start_time.isoformat(), end_time.isoformat())
-        
-        processed_count = 0
-        error_count = 0
-        
-        for log in logs:
-            try:
-                log_data = log['log']
-                if isinstance(log_data, str):
-                    log_data = json.loads(log_data)
-
-                server_id = log_data.get('serverid')
-                project_key = log_data.get('projectkey')
-                msg_type = log_data.get('messagetypeid')
-                timestamp = int(log['timestamp'])
-
-                if all(v is not None for v in [server_id, project_key, msg_type]):
-                    self.metrics_state.update_metrics(server_id, project_key, msg_type, timestamp)
-                    processed_count += 1
-                else:
-                    logger.warning(f"Incomplete log data: {log_data}")
+class MetricsStateCollector:
+    """Prometheus collector generating the summary metric families from
+    MetricsState at scrape time, so no gauge has to be kept up to date"""
 
-            except Exception as e:
-                error_count += 1
-                logger.error(f"Error processing log entry: {e}")
-                continue
+    def __init__(self, metrics_state, lock):
+        self.metrics_state = metrics_state
+        self.lock = lock
 
-        # Push metrics to Prometheus
-        try:
-            push_to_gateway(self.prometheus_url, job=Config.PROMETHEUS_JOB_NAME, registry=REGISTRY)
-            logger.info(f"Successfully pushed metrics to Prometheus. Processed: {processed_count}, Errors: {error_count}")
-        except Exception as e:
-            logger.error(f"Failed to push to Prometheus: {e}")
+    def describe(self):
+        return []
 
-    def get_logs(self, query, start_time, end_time, limit=5000):
-        """Query logs from Loki with comprehensive error handling"""
-        try:
-            logger.debug(f"Querying Loki with params: query={query}, start={start_time}, end={end_time}, limit={limit}")
-            params = {
-                'query': query,
-                'start': start_time,
-                'end': end_time,
-                'limit': limit,
-            }
+    def collect(self):
+        with self.lock:
+            return metric_families(self.metrics_state.iter_samples())
 
-            response = requests.get(self.query_endpoint, params=params, timeout=30)
-            response.raise_for_status()
-            data = response.json()
-            logger.debug(f"Successfully retrieved {len(response.content)} bytes from Loki")
-            
-            if 'data' in data and 'result' in data['data']:
-                results = self._parse_results(data['data']['result'])
-                logger.info(f"Found {len(results)} log entries")
-                return results
-            else:
-                logger.warning("No results found in Loki response")
-                return []
-        
-        except requests.exceptions.Timeout:
-            logger.error(f"Timeout while querying Loki endpoint: {self.query_endpoint}")
-            return []
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to query Loki: {str(e)}")
-            logger.debug(f"Stack trace: {traceback.format_exc()}")
-            return []
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode Loki response: {str(e)}")
-            logger.debug(f"Response content: {response.content[:1000]}...")
-            return []
-        except Exception as e:
-            logger.error(f"Unexpected error querying Loki: {str(e)}")
-            logger.debug(f"Stack trace: {traceback.format_exc()}")
-            return []
+# A decoded ActivityLog entry, reduced to the fields the metrics use. The raw
+# line is not kept: event_key is its dedup key (EventDeduplicator.event_key),
+# and stream the stream key the cursor needs, shared by the stream's entries
+LogEntry = namedtuple('LogEntry', ['timestamp', 'stream', 'event_key', 'server_id', 'project_key', 'msg_type'])
 
-    def _parse_results(self, results):
-        """Parse Loki results with detailed logging"""
-        parsed_logs = []
-        parse_errors = 0
-        logger.debug(f"Parsing {len(results)} result streams")
+def body_json(log_line):
+    """The ActivityLog JSON of a collector line `... Body: Map({...}) ...`; lines
+    that are already a JSON body (line_format queries, OTLP) are returned as is"""
+    if log_line.startswith('{'):
+        return log_line
+    start = log_line.find('Body: Map(')
+    end = log_line.rfind('})')
+    if start < 0 or end < start:
+        raise ValueError('no ActivityLog body in line')
+    return log_line[start + 10:end + 1]
 
-        for stream in results:
-            labels = stream.get('stream', {})
-            values = stream.get('values', [])
-            logger.debug(f"Processing stream with labels: {labels}, containing {len(values)} values")
+def activity_fields(log_data):
+    """Project a decoded ActivityLog body to (serverid, projectkey, messagetypeid)"""
+    return log_data.get('serverid'), log_data.get('projectkey'), log_data.get('messagetypeid')
 
-            for value in values:
-                try:
-                    timestamp, log_line = value
-                    try:
-                        log_data = json.loads(log_line)
-                        logger.debug(f"Successfully parsed JSON log entry at timestamp {timestamp}")
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Failed to parse JSON at timestamp {timestamp}: {str(e)}")
-                        log_data = log_line
-                        parse_errors += 1
-
-                    parsed_logs.append({
-                        'timestamp': timestamp,
-                        'labels': labels,
-                        'log': log_data
-                    })
-                except Exception as e:
-                    logger.error(f"Error processing log value: {str(e)}")
-                    logger.debug(f"Problematic value: {value}")
-                    parse_errors += 1
-                    continue
+def write_json_atomic(path, data):
+    """Write data as JSON to a temp file, then rename it over path, so a crash
+    never leaves a partially written file behind"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
-        if parse_errors > 0:
-            logger.warning(f"Encountered {parse_errors} parsing errors while processing {len(parsed_logs)} logs")
-        else:
-            logger.info(f"Successfully parsed {len(parsed_logs)} logs without errors")
-        return parsed_logs
+class LokiResponseParser:
+    """Incremental parser for a query_range response body read in chunks.
 
-def main():
-    try:
-        logger.info("Starting Loki Reader service")
-        logger.info(f"Configuration: Log level={Config.LOG_LEVEL}, Loki Server={Config.LOKI_SERVER_HOST}:{Config.LOKI_SERVER_PORT}")
-        logger.info(f"Prometheus Gateway: {Config.PROMETHEUS_GATEWAY}")
-        
-        reader = LokiLogReader()
-        consecutive_errors = 0
-        max_consecutive_errors = 3
-        
-        # Process logs every minute
+    entries() yields (labels, timestamp, line) for every entry of data.result
+    as soon as it has been received; only the small pieces (stream labels and
+    individual [timestamp, line] pairs) are decoded, so neither the body nor
+    its decoded tree is ever held in memory.
+    """
+    RESULT_ARRAY = re.compile(r'"result"\s*:\s*\[')
+    SEPARATORS = re.compile(r'[\s,]*')
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+
+    def _fill(self):
+        """Append the next chunk of the body to the buffer; False at the end of the body"""
+        for chunk in self._chunks:
+            if chunk:
+                self._buf = self._buf[self._pos:] + self._text.decode(chunk)
+                self._pos = 0
+                return True
+        return False
+
+    def _peek(self):
+        """Skip whitespace and commas; return the next character, or None at the end of the body"""
+        while True:
+            self._pos = self.SEPARATORS.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Malformed Loki response: expected {char!r}")
+        self._pos += 1
+
+    def _value(self):
+        """Decode the next JSON value, reading more of the body until it is complete"""
+        self._peek()
         while True:
             try:
-                reader.process_logs(minutes=Config.UNRESPONSIVE_TIMEOUT_MINUTES)
-                if consecutive_errors > 0:
-                    logger.info(f"Successfully recovered after {consecutive_errors} errors")
-                    consecutive_errors = 0
-                logger.info("Completed log processing cycle")
-                time.sleep(60)  # Wait for 1 minute before next processing
-
-            except KeyboardInterrupt:
-                logger.info("Received shutdown signal, stopping service...")
+                value, self._pos = self._decoder.raw_decode(self._buf, self._pos)
+                return value
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+    def entries(self):
+        while True:
+            match = self.RESULT_ARRAY.search(self._buf, self._pos)
+            if match:
+                self._pos = match.end()
                 break
+            # Keep enough of the buffer to find a key split across chunks
+            self._pos = max(self._pos, len(self._buf) - 32)
+            if not self._fill():
+                return
 
-            except Exception as e:
-                consecutive_errors += 1
-                logger.error(f"Error in main loop (attempt {consecutive_errors}): {str(e)}")
-                logger.debug(f"Stack trace: {traceback.format_exc()}")
+        while True:
+            char = self._peek()
+            if char == ']':
+                return
+            if char != '{':
+                raise ValueError("Malformed Loki response: expected a stream object")
+            self._pos += 1
+
+            labels = None
+            pending = []  # values that came before the stream labels
+            while self._peek() != '}':
+                key = self._value()
+                self._expect(':')
+                if key == 'stream':
+                    labels = self._value()
+                elif key == 'values':
+                    self._expect('[')
+                    while self._peek() != ']':
+                        timestamp, line = self._value()
+                        if labels is None:
+                            pending.append((timestamp, line))
+                        else:
+                            yield labels, timestamp, line
+                    self._pos += 1
+                else:
+                    self._value()
+            self._pos += 1
+
+            for timestamp, line in pending:
+                yield labels or {}, timestamp, line
+
+    def drain(self):
+        """Consume the rest of the body"""
+        for _ in self._chunks:
+            pass
+
+class StreamCursor:
+    """Per-stream read position: last timestamp (ns) plus the number of entries
+    already consumed at that timestamp, used as a tie-break for equal timestamps"""
+
+    def __init__(self, positions=None):
+        self.positions = positions or {}
+        self._seen = {}
+
+    @staticmethod
+    def stream_key(labels):
+        """Stable key for a Loki stream label set"""
+        return json.dumps(labels, sort_keys=True)
+
+    def begin(self):
+        """Start a new pass over a (possibly overlapping) query result"""
+        self._seen = {}
+
+    def accept(self, stream, timestamp):
+        """Return True if the entry is past the cursor and advance the cursor.
+        Entries of a stream must be fed in ascending timestamp order."""
+        position = self.positions.get(stream)
+        if position is None or timestamp > position[0]:
+            self.positions[stream] = [timestamp, 1]
+            self._seen[stream] = 1
+            return True
+        if timestamp < position[0]:
+            return False
+
+        seen = self._seen.get(stream, 0) + 1
+        self._seen[stream] = seen
+        if seen > position[1]:
+            position[1] = seen
+            return True
+        return False
+
+    def start_time(self, floor):
+        """Earliest timestamp still needed by any stream, never older than floor"""
+        if not self.positions:
+            return floor
+        return max(min(position[0] for position in self.positions.values()), floor)
+
+    def prune(self, floor):
+        """Forget streams that have been silent since before floor"""
+        self.positions = {
+            stream: position for stream, position in self.positions.items()
+            if position[0] >= floor
+        }
+
+    def load(self, path):
+        """Load cursor positions from disk, starting empty if unavailable"""
+        try:
+            with open(path) as f:
+                self.positions = {stream: list(position) for stream, position in json.load(f).items()}
+            logger.info(f"Loaded cursor for {len(self.positions)} streams from {path}")
+        except FileNotFoundError:
+            logger.info(f"No cursor file found at {path}, starting from the default window")
+        except Exception as e:
+            logger.error(f"Failed to load cursor from {path}: {e}")
+            self.positions = {}
+
+    def save(self, path):
+        """Persist cursor positions atomically"""
+        try:
+            write_json_atomic(path, self.positions)
+        except Exception as e:
+            logger.error(f"Failed to save cursor to {path}: {e}")
+
+class LokiTailStream:
+    """Long-lived connection to Loki's /loki/api/v1/tail websocket.
+
+    Entries are fed into the reader's MetricsState as they arrive. Every
+    (re)connect first backfills the gap since the cursor through query_range
+    (at most RESET_TIMEOUT_HOURS back; without a cursor the last
+    UNRESPONSIVE_TIMEOUT_MINUTES), then tails from the backfill end; the
+    shared cursor drops any overlap. The timeouts run on event time from the
+    backfill until the tail is connected.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.tail_url = f"ws://{Config.LOKI_SERVER_HOST}:{Config.LOKI_SERVER_PORT}/loki/api/v1/tail"
+        self.connected = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the tail connection in a background thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='loki-tail', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Close the tail connection and wait for the thread to exit"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        backoff = 1
+        while not self._stop_event.is_set():
+            try:
+                end_ns = time.time_ns()
+                if self.reader.cursor.positions:
+                    minutes = Config.RESET_TIMEOUT_HOURS * 60
+                else:
+                    minutes = Config.UNRESPONSIVE_TIMEOUT_MINUTES
+                # The gap is applied on event time; the wall-clock timeouts wait until the tail is live
+                self._catch_up(end_ns - minutes * 60 * 1_000_000_000)
+                processed_count, error_count = self.reader.backfill(minutes, end_ns)
+                logger.info(f"Backfilled tail gap. Processed: {processed_count}, Errors: {error_count}")
+
+                params = urlencode({
+                    'query': self.reader.log_query,
+                    'start': end_ns,
+                    'limit': Config.TAIL_LIMIT,
+                })
+                with websocket_connect(f"{self.tail_url}?{params}", open_timeout=30) as websocket:
+                    self.connected = True
+                    backoff = 1
+                    self.reader.cursor.begin()
+                    logger.info(f"Connected to Loki tail endpoint: {self.tail_url}")
+                    self._go_live()
+                    self._receive(websocket)
+
+            except Exception as e:
+                if self._stop_event.is_set():
+                    break
+                logger.error(f"Loki tail connection failed: {e}")
+                logger.debug(f"Stack trace: {traceback.format_exc()}")
+            finally:
+                self.connected = False
+                self._go_live()
+
+            logger.info(f"Reconnecting to Loki tail in {backoff} seconds...")
+            self._stop_event.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def _catch_up(self, start_ns):
+        with self.reader.state_lock:
+            self.reader.metrics_state.begin_catch_up(start_ns)
+
+    def _go_live(self):
+        with self.reader.state_lock:
+            self.reader.metrics_state.end_catch_up()
+
+    def _receive(self, websocket):
+        while not self._stop_event.is_set():
+            try:
+                message = websocket.recv(timeout=1)
+            except TimeoutError:
+                continue
+
+            data = json_loads(message)
+            dropped = data.get('dropped_entries') or []
+            if dropped:
+                logger.warning(f"Loki tail dropped {len(dropped)} entries")
+
+            logs = self.reader._parse_results(data.get('streams') or [])
+            self.reader.ingest_logs(logs, use_cursor=True)
+
+class OtlpLogsReceiver:
+    """OTLP/HTTP logs receiver (POST /v1/logs, JSON or protobuf, optionally gzipped).
+
+    ActivityLog records are taken from the log record body (a map, or a JSON
+    string) and applied to MetricsState directly, without the debug exporter
+    text / Loki / regex round trip.
+    """
+
+    def __init__(self, reader, host=None, port=None):
+        self.reader = reader
+        self.host = host or Config.OTLP_RECEIVER_HOST
+        self.port = Config.OTLP_RECEIVER_PORT if port is None else port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._server = ThreadingHTTPServer((self.host, self.port), _OtlpRequestHandler)
+        self._server.receiver = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='otlp-receiver', daemon=True)
+        self._thread.start()
+        logger.info(f"OTLP/HTTP logs receiver listening on {self.host}:{self.port}")
+
+    def stop(self):
+        """Stop serving"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def export(self, body, content_type):
+        """Decode an ExportLogsServiceRequest and ingest its records.
+
+        Returns (processed, errors); raises ValueError for undecodable bodies.
+        """
+        if content_type == 'application/x-protobuf':
+            if logs_service_pb2 is None:
+                raise ValueError("protobuf OTLP requires the opentelemetry-proto package")
+            message = logs_service_pb2.ExportLogsServiceRequest()
+            message.ParseFromString(body)
+            request = MessageToDict(message)
+        else:
+            request = json_loads(body)
+
+        logs = list(self._iter_records(request))
+        return self.reader.ingest_logs(logs, use_cursor=False)
+
+    def _iter_records(self, request):
+        for resource_logs in request.get('resourceLogs', []):
+            for scope_logs in resource_logs.get('scopeLogs', []):
+                for record in scope_logs.get('logRecords', []):
+                    timestamp = None
+                    try:
+                        timestamp = self._timestamp(record)
+                        log_data = self._any_value(record.get('body', {}))
+                        if isinstance(log_data, str):
+                            line = log_data
+                            log_data = json_loads(line)
+                        else:
+                            line = json.dumps(log_data, sort_keys=True)
+                        fields = activity_fields(log_data)
+                    except (ValueError, TypeError, KeyError, AttributeError):
+                        if event_log_sampler.allow('invalid_json'):
+                            logger.warning(f"Skipping invalid OTLP log record at timestamp {timestamp}")
+                        continue
+                    yield LogEntry(timestamp, '', EventDeduplicator.event_key('', timestamp, line), *fields)
+
+    @staticmethod
+    def _timestamp(record):
+        """Record time in ns: timeUnixNano, else observedTimeUnixNano, else now.
+        Both are uint64 strings in OTLP/JSON, where unset is "0" rather than absent."""
+        for field in ('timeUnixNano', 'observedTimeUnixNano'):
+            timestamp = int(record.get(field) or 0)
+            if timestamp:
+                return timestamp
+        return time.time_ns()
+
+    @classmethod
+    def _any_value(cls, value):
+        """Convert an OTLP AnyValue (JSON mapping) to a plain Python value"""
+        if 'stringValue' in value:
+            return value['stringValue']
+        if 'intValue' in value:
+            return int(value['intValue'])
+        if 'doubleValue' in value:
+            return float(value['doubleValue'])
+        if 'boolValue' in value:
+            return value['boolValue']
+        if 'kvlistValue' in value:
+            return {
+                kv['key']: cls._any_value(kv.get('value', {}))
+                for kv in value['kvlistValue'].get('values', [])
+            }
+        if 'arrayValue' in value:
+            return [cls._any_value(v) for v in value['arrayValue'].get('values', [])]
+        return None
+
+class _OtlpRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.rstrip('/') != '/v1/logs':
+            self._respond(404, b'', 'text/plain')
+            return
+
+        content_type = self.headers.get('Content-Type', 'application/json').split(';')[0].strip()
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+            processed_count, error_count = self.server.receiver.export(body, content_type)
+            logger.debug(f"OTLP export processed {processed_count} records with {error_count} errors")
+        except Exception as e:
+            logger.error(f"Failed to decode OTLP logs request: {e}")
+            self._respond(400, json.dumps({'message': str(e)}).encode(), 'application/json')
+            return
+
+        if content_type == 'application/x-protobuf':
+            self._respond(200, logs_service_pb2.ExportLogsServiceResponse().SerializeToString(), content_type)
+        else:
+            self._respond(200, b'{}', 'application/json')
+
+    def _respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"OTLP receiver: {format % args}")
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of sending a request while the endpoint's circuit is open"""
+
+class CircuitBreaker:
+    """Per-endpoint circuit breaker.
+
+    After `failure_threshold` consecutive failures the circuit opens and requests
+    fail fast for `reset_seconds`. Then a single trial request is let through
+    (half-open): success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit for {self.name} closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if not self.trial:
+                    logger.warning(f"Circuit for {self.name} opened after {self.failures} consecutive failures, "
+                                   f"failing fast for {self.reset_seconds}s")
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+class HttpClient:
+    """Keep-alive connection pool to one endpoint, with jittered retries and a circuit breaker.
+
+    Responses are requested gzip-compressed (requests decodes them transparently).
+    Connection errors, timeouts and 429/5xx responses are retried up to
+    HTTP_RETRIES times with full-jitter exponential backoff, waiting at least
+    the response's Retry-After; they count as failures for the endpoint's
+    circuit breaker, as does any other error raised by a request.
+    """
+    MAX_RETRY_AFTER_SECONDS = 30
+
+    def __init__(self, name, pool_size):
+        self.name = name
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        self.breaker = CircuitBreaker(name, Config.BREAKER_FAILURE_THRESHOLD, Config.BREAKER_RESET_SECONDS)
+
+    def request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuit for {self.name} is open, not sending request")
+            retry_after = 0
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.breaker.record_failure()
+                if attempt >= Config.HTTP_RETRIES:
+                    raise
+            except Exception:
+                # Not retried, but it must still settle a half-open trial
+                self.breaker.record_failure()
+                raise
+            else:
+                if not self.should_retry(response.status_code):
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt >= Config.HTTP_RETRIES:
+                    return response
+                retry_after = self.retry_after(response)
+                response.close()
+
+            delay = max(retry_after, random.uniform(0, Config.HTTP_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+            attempt += 1
+            logger.warning(f"Retrying {self.name} request in {delay:.2f}s (retry {attempt} of {Config.HTTP_RETRIES})")
+            time.sleep(delay)
+
+    @staticmethod
+    def should_retry(status_code):
+        """Rate limited (429) and server errors (5xx) are retried"""
+        return status_code == 429 or status_code >= 500
+
+    @classmethod
+    def retry_after(cls, response):
+        """Seconds to wait from a Retry-After header in seconds (0 without one), at most MAX_RETRY_AFTER_SECONDS"""
+        try:
+            return min(max(0.0, float(response.headers.get('Retry-After', 0))), cls.MAX_RETRY_AFTER_SECONDS)
+        except ValueError:
+            return 0  # an HTTP date; the backoff applies
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def push_handler(self, url, method, timeout, headers, data):
+        """push_to_gateway handler sending through the pool, gzip-compressing the body if PUSH_GZIP is set"""
+        headers = dict(headers)
+        if Config.PUSH_GZIP and data:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+
+        def handle():
+            response = self.request(method, url, data=data, headers=headers, timeout=timeout)
+            with response:
+                if response.status_code >= 400:
+                    raise OSError(f"error talking to pushgateway: {response.status_code} {response.text}")
+        return handle
+
+    def close(self):
+        self.session.close()
+
+class GroupedPusher:
+    """Pushes the summary metrics to the Pushgateway as one group per projectkey.
+
+    Only the groups handed to push() are sent, with pushadd, so a cycle transfers
+    the projects that changed rather than the whole fleet; an empty group is
+    deleted. The job-wide group left by PUSH_MODE=full is deleted once.
+    """
+
+    def __init__(self, gateway, client):
+        self.gateway = gateway
+        self.client = client
+        self.legacy_group_deleted = False
+
+    def push(self, groups):
+        """Push {project_key: samples}, returning the project keys that failed"""
+        if not self.legacy_group_deleted:
+            try:
+                delete_from_gateway(self.gateway, job=Config.PROMETHEUS_JOB_NAME, handler=self.client.push_handler)
+                self.legacy_group_deleted = True
+            except Exception as e:
+                logger.error(f"Failed to delete the job-wide Pushgateway group: {e}")
+
+        failed = set()
+        project_keys = list(groups)
+        for index, project_key in enumerate(project_keys):
+            grouping_key = {'projectkey': project_key}
+            try:
+                if groups[project_key]:
+                    pushadd_to_gateway(self.gateway, job=Config.PROMETHEUS_JOB_NAME,
+                                       registry=SamplesCollector(groups[project_key]),
+                                       grouping_key=grouping_key, handler=self.client.push_handler)
+                else:
+                    delete_from_gateway(self.gateway, job=Config.PROMETHEUS_JOB_NAME,
+                                        grouping_key=grouping_key, handler=self.client.push_handler)
+            except CircuitOpenError as e:
+                logger.error(f"Failed to push to Prometheus: {e}")
+                failed.update(project_keys[index:])
+                break
+            except Exception as e:
+                logger.error(f"Failed to push project {project_key} to Prometheus: {e}")
+                failed.add(project_key)
+        return failed
+
+class CycleStats:
+    """Figures of one ingest cycle, added to from the fetch threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = 0
+        self.bytes = 0
+        self.parse_seconds = 0.0
+        self.apply_seconds = 0.0
+
+    def add(self, lines=0, bytes_read=0, parse_seconds=0.0, apply_seconds=0.0):
+        with self.lock:
+            self.lines += lines
+            self.bytes += bytes_read
+            self.parse_seconds += parse_seconds
+            self.apply_seconds += apply_seconds
+
+class LokiLogReader:
+    CHECKPOINT_VERSION = 2
+    INGEST_BATCH_SIZE = 5000
+
+    def __init__(self, shard=None, samples_queue=None):
+        self.loki_url = f"http://{Config.LOKI_SERVER_HOST}:{Config.LOKI_SERVER_PORT}"
+        self.query_endpoint = f"{self.loki_url}/loki/api/v1/query_range"
+        self.prometheus_url = Config.PROMETHEUS_GATEWAY
+        self.loki = HttpClient('loki', Config.MAX_WORKERS)
+        self.pushgateway = HttpClient('pushgateway', 1)
+        self.pusher = GroupedPusher(self.prometheus_url, self.pushgateway)
+        self.metrics_state = MetricsState()
+        self.cursor = StreamCursor()
+        self.state_lock = threading.RLock()
+        self.tail_stream = None
+        self.otlp_receiver = None
+        self.pull_registry = None
+        self.replay_from_ns = None
+        self.last_checkpoint = time.monotonic()
+        # Bounds concurrent Loki requests across fetches, counts and discovery
+        self.loki_slots = threading.BoundedSemaphore(Config.MAX_WORKERS)
+        self.cycle_deadline = None  # time.monotonic() at which fetching stops
+        self.cycle_stats = CycleStats()
+        # With aggregation pushdown only status-changing lines are fetched raw
+        self.pushdown = not self.metrics_state.count_events
+        self.base_query = Config.LOKI_STATUS_QUERY if self.pushdown else Config.LOKI_QUERY
+        self.log_query = self.base_query
+        # A shard worker (index, count) only queries its own projects and hands
+        # its samples to the coordinator through samples_queue
+        self.shard = shard
+        self.samples_queue = samples_queue
+        self.shard_projects = {}  # project_key -> time it was last discovered
+        self.shard_filter = ''
+        # With checkpointing the cursor is restored together with the state it produced
+        if Config.CHECKPOINT_INTERVAL_SECONDS > 0:
+            self.load_checkpoint()
+        elif Config.INGEST_MODE in ('cursor', 'tail'):
+            self.cursor.load(Config.CURSOR_FILE)
+        logger.info(f"Initialized LokiLogReader with Loki URL: {self.loki_url}")
+        logger.info(f"Using Prometheus gateway: {self.prometheus_url}")
+        logger.info(f"Ingest mode: {Config.INGEST_MODE}{' with aggregation pushdown' if self.pushdown else ''}")
+        if shard is not None:
+            logger.info(f"Running as shard {shard[0] + 1} of {shard[1]}")
+
+    def start_metrics_server(self, port=None):
+        """Serve /metrics generated from the metrics state at scrape time"""
+        port = Config.METRICS_PORT if port is None else port
+        self.pull_registry = CollectorRegistry()
+        self.pull_registry.register(MetricsStateCollector(self.metrics_state, self.state_lock))
+        self.pull_registry.register(READER_REGISTRY)
+        start_http_server(port, registry=self.pull_registry)
+        logger.info(f"Serving metrics on port {port}")
+
+    def save_checkpoint(self, path=None):
+        """Snapshot the metrics state and ingest cursor to disk atomically"""
+        path = path or Config.CHECKPOINT_FILE
+        try:
+            started = time.monotonic()
+            with self.state_lock:
+                checkpoint = {
+                    'version': self.CHECKPOINT_VERSION,
+                    'saved_at': time.time_ns(),
+                    'state': self.metrics_state.snapshot(),
+                    'cursor': {stream: list(position) for stream, position in self.cursor.positions.items()},
+                }
+            write_json_atomic(path, checkpoint)
+            self.last_checkpoint = time.monotonic()
+            logger.info(f"Saved checkpoint of {len(checkpoint['state']['sessions'])} servers to {path} "
+                        f"in {(time.monotonic() - started) * 1000:.1f} ms")
+        except Exception as e:
+            logger.error(f"Failed to save checkpoint to {path}: {e}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+
+    def load_checkpoint(self, path=None):
+        """Restore the metrics state and ingest cursor from the last checkpoint.
+
+        The next query window is extended back to the checkpoint (bounded by
+        RESET_TIMEOUT_HOURS) so only the gap since it is replayed. Returns True
+        if a checkpoint was restored.
+        """
+        path = path or Config.CHECKPOINT_FILE
+        try:
+            started = time.monotonic()
+            with open(path) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('version') != self.CHECKPOINT_VERSION:
+                logger.warning(f"Ignoring checkpoint {path} with unsupported version {checkpoint.get('version')}")
+                return False
+
+            metrics_state = MetricsState()
+            server_count = metrics_state.restore(checkpoint['state'])
+            with self.state_lock:
+                self.metrics_state = metrics_state
+                self.cursor.positions = {stream: list(position) for stream, position in checkpoint.get('cursor', {}).items()}
+            self.replay_from_ns = metrics_state.dedup.watermark or checkpoint.get('saved_at')
+            logger.info(f"Restored checkpoint of {server_count} servers from {path} "
+                        f"in {(time.monotonic() - started) * 1000:.1f} ms")
+            return True
+        except FileNotFoundError:
+            logger.info(f"No checkpoint found at {path}, starting from the default window")
+        except Exception as e:
+            logger.error(f"Failed to load checkpoint from {path}: {e}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+        return False
+
+    def _window_start(self, end_ns, minutes):
+        """Start of the query window ending at end_ns: the last N minutes, reaching
+        back to the restored checkpoint once so the gap since it is replayed"""
+        start_ns = end_ns - minutes * 60 * 1_000_000_000
+        if self.replay_from_ns is not None:
+            replay_ns = max(self.replay_from_ns, end_ns - MetricsState._reset_timeout_ns())
+            if replay_ns < start_ns:
+                logger.info(f"Replaying {(start_ns - replay_ns) / 1_000_000_000:.0f}s of logs since the checkpoint")
+                start_ns = replay_ns
+            self.replay_from_ns = None
+        return start_ns
+
+    def process_logs(self, minutes=5):
+        """
+        Query and process logs from the last N minutes, or in cursor mode only
+        the logs newer than the stored cursor (bounded by the last N minutes),
+        then push the metrics
+        """
+        processed_count, error_count = self.ingest_cycle(minutes)
+        self.push_metrics(processed_count, error_count)
+
+    def ingest_cycle(self, minutes=5):
+        """Query and ingest one cycle's logs (see process_logs), returning (processed, errors)"""
+        started = time.perf_counter()
+        self.cycle_stats = stats = CycleStats()
+        if self.shard is not None:
+            self.refresh_shard_projects()
+            if not self.shard_projects:
+                logger.info("No projects assigned to this shard yet")
+                return 0, 0
+
+        use_cursor = Config.INGEST_MODE == 'cursor'
+        if use_cursor:
+            processed_count, error_count = self.backfill(minutes)
+        else:
+            end_ns = time.time_ns()
+            start_ns = self._window_start(end_ns, minutes)
+            logger.debug(f"Querying logs from {start_ns} to {end_ns}")
+
+            logs = self.get_logs(self.log_query, start_ns, end_ns)
+            processed_count, error_count = self.ingest_window(logs, start_ns, end_ns, use_cursor=False)
+
+        # Fetching is the rest of the ingest time, waiting for and scanning responses
+        elapsed = time.perf_counter() - started
+        CYCLE_STAGE_SECONDS.labels('fetch').observe(max(0.0, elapsed - stats.parse_seconds - stats.apply_seconds))
+        CYCLE_STAGE_SECONDS.labels('parse').observe(stats.parse_seconds)
+        CYCLE_STAGE_SECONDS.labels('apply').observe(stats.apply_seconds)
+        CYCLE_LINES.observe(stats.lines)
+        CYCLE_BYTES.observe(stats.bytes)
+        return processed_count, error_count
+
+    @staticmethod
+    def shard_of(project_key, shard_count):
+        """Shard index owning a project key"""
+        return zlib.crc32(str(project_key).encode()) % shard_count
+
+    def refresh_shard_projects(self, end_ns=None):
+        """Discover this shard's project keys with a LogQL metric query and
+        restrict the log queries to them with a line filter.
+
+        The first discovery looks back RESET_TIMEOUT_HOURS to cover a replay
+        after restart, later ones the last UNRESPONSIVE_TIMEOUT_MINUTES; keys
+        not rediscovered within RESET_TIMEOUT_HOURS are dropped. The lines of
+        keys found by a later discovery were skipped by the earlier queries,
+        so they are caught up over that lookback (see catch_up_projects).
+        """
+        end_ns = end_ns or time.time_ns()
+        index, shard_count = self.shard
+        known = set(self.shard_projects)
+        if known:
+            lookback = Config.UNRESPONSIVE_TIMEOUT_MINUTES * 60
+        else:
+            lookback = Config.RESET_TIMEOUT_HOURS * 60 * 60
+        query = (f'count by (projectkey) (count_over_time({Config.LOKI_QUERY} {Config.LOKI_BODY_STAGES} '
+                 f'| json projectkey="projectkey" [{lookback}s]))')
+        results = self._query_metric(query, end_ns, end_ns, lookback)
+        if results is None:
+            return  # keep the current projects
+
+        for series in results:
+            project_key = series.get('metric', {}).get('projectkey')
+            if project_key and '`' not in project_key and self.shard_of(project_key, shard_count) == index:
+                self.shard_projects[project_key] = end_ns
+        expired_ns = end_ns - MetricsState._reset_timeout_ns()
+        self.shard_projects = {
+            project_key: seen for project_key, seen in self.shard_projects.items() if seen >= expired_ns
+        }
+
+        self.shard_filter = self.project_filter(self.shard_projects)
+        self.log_query = self.base_query + self.shard_filter
+        logger.debug(f"Shard {index} owns {len(self.shard_projects)} projects")
+
+        new_projects = set(self.shard_projects) - known if known else set()
+        if new_projects:
+            self.catch_up_projects(new_projects, end_ns - lookback * 1_000_000_000, end_ns)
+
+    @staticmethod
+    def project_filter(project_keys):
+        """LogQL line filter for the lines of the given projects ('' for none)"""
+        projects = '|'.join(re.escape(project_key) for project_key in sorted(project_keys))
+        return rf' |~ `"projectkey":\s*"?(?:{projects})"?\s*[,}}]`' if projects else ''
+
+    def catch_up_projects(self, project_keys, start_ns, end_ns):
+        """Ingest the lines of newly discovered projects between start_ns and end_ns.
+
+        The cursor has already moved past them and the oldest are behind the
+        dedup watermark, so they bypass both; none of them can have been
+        applied before. Later queries that overlap are deduplicated as usual.
+        """
+        logs = self.get_logs(self.base_query + self.project_filter(project_keys), start_ns, end_ns)
+        processed_count, error_count = self.ingest_logs(logs, use_cursor=False, accept_late=True)
+        logger.info(f"Caught up {len(project_keys)} new projects. Processed: {processed_count}, Errors: {error_count}")
+
+    def backfill(self, minutes=5, end_ns=None):
+        """Process logs between the stored cursor and end_ns (default now),
+        looking back at most N minutes, and persist the advanced cursor"""
+        end_ns = end_ns or time.time_ns()
+        window_start_ns = self._window_start(end_ns, minutes)
+
+        self.cursor.prune(window_start_ns)
+        start_ns = self.cursor.start_time(window_start_ns)
+        logger.debug(f"Querying logs from {start_ns} to {end_ns}")
+
+        logs = self.get_logs(self.log_query, start_ns, end_ns)
+        with self.state_lock:
+            self.cursor.begin()
+        processed_count, error_count = self.ingest_window(logs, start_ns, end_ns, use_cursor=True)
+        with self.state_lock:
+            self.cursor.save(Config.CURSOR_FILE)
+        return processed_count, error_count
+
+    def ingest_window(self, logs, start_ns, end_ns, use_cursor, accept_late=False):
+        """ingest_logs() for the entries of [start_ns, end_ns). A window reaching back
+        further than UNRESPONSIVE_TIMEOUT_MINUTES catches up on a gap (restart,
+        outage, reconnect), so its timeouts run on event time until it is ingested."""
+        # A caller that already runs on event time decides when it has caught up
+        if (self.metrics_state.catch_up_clock is not None
+                or start_ns >= end_ns - MetricsState._unresponsive_timeout_ns()):
+            return self.ingest_logs(logs, use_cursor, accept_late)
+        with self.state_lock:
+            self.metrics_state.begin_catch_up(start_ns)
+        try:
+            return self.ingest_logs(logs, use_cursor, accept_late)
+        finally:
+            with self.state_lock:
+                self.metrics_state.end_catch_up()
+
+    def ingest_logs(self, logs, use_cursor, accept_late=False):
+        """Feed parsed log entries into the metrics state, returning (processed, errors).
+
+        Entries are pulled from the (possibly still downloading) iterator in
+        batches of INGEST_BATCH_SIZE; the state lock is only held while a
+        batch is applied.
+        """
+        counts = {'skipped': 0, 'errors': 0}
+        processed_count = 0
+        logs = iter(logs)
+
+        while True:
+            batch = list(islice(logs, self.INGEST_BATCH_SIZE))
+            if not batch:
+                break
+            started = time.perf_counter()
+            with self.state_lock:
+                processed_count += self.metrics_state.apply_batch(
+                    self._iter_events(batch, use_cursor, counts), accept_late
+                )
+            self.cycle_stats.add(apply_seconds=time.perf_counter() - started)
+
+        PARSE_ERRORS.inc(counts['errors'])
+        if use_cursor:
+            logger.debug(f"Skipped {counts['skipped']} entries already behind the cursor")
+        return processed_count, counts['errors']
+
+    def _iter_events(self, logs, use_cursor, counts):
+        """Yield (server_id, project_key, msg_type, timestamp, event_key) for each valid log entry"""
+        for entry in logs:
+            try:
+                if use_cursor and not self.cursor.accept(entry.stream, entry.timestamp):
+                    counts['skipped'] += 1
+                    continue
+
+                if entry.server_id is None or entry.project_key is None or entry.msg_type is None:
+                    if event_log_sampler.allow('incomplete'):
+                        logger.warning(f"Incomplete log data at timestamp {entry.timestamp}: serverid={entry.server_id}, "
+                                       f"projectkey={entry.project_key}, messagetypeid={entry.msg_type}")
+                    continue
+            except Exception as e:
+                counts['errors'] += 1
+                if event_log_sampler.allow('entry_error'):
+                    logger.error(f"Error processing log entry: {e}")
+                continue
+
+            yield entry.server_id, entry.project_key, entry.msg_type, entry.timestamp, entry.event_key
+
+    def count_query(self, range_seconds):
+        """LogQL metric query counting messages per server and type over range_seconds"""
+        return (
+            f'sum by (serverid, projectkey, messagetypeid) (count_over_time({Config.LOKI_QUERY}{self.shard_filter} '
+            f'{Config.LOKI_BODY_STAGES} '
+            f'| json serverid="serverid", projectkey="projectkey", messagetypeid="messagetypeid" '
+            f'[{range_seconds}s]))'
+        )
+
+    def pull_counts(self, end_ns=None):
+        """Apply per-bucket message counts from Loki for the complete buckets since
+        the last pull (at most the last hour), returning the number of samples"""
+        return self.apply_pulled_counts(self.fetch_counts(end_ns))
+
+    def fetch_counts(self, end_ns=None):
+        """Query the counts for pull_counts() without applying them, returning
+        (samples, end_ns) for apply_pulled_counts(), or None if there are none.
+
+        The raw status lines up to end_ns have to be ingested before the counts
+        are applied: a start among them replaces the session, and with it the
+        counts applied to it before.
+        """
+        if self.shard is not None and not self.shard_projects:
+            return None
+        step = Config.WINDOW_BUCKET_SECONDS
+        step_ns = step * 1_000_000_000
+        end_ns = (end_ns or time.time_ns()) // step_ns * step_ns
+        start_ns = max(self.metrics_state.counted_until, end_ns - MetricsState.HOUR_NS)
+        if start_ns >= end_ns:
+            return None
+
+        # Evaluated at every bucket end after start_ns, each covering the preceding step
+        results = self._query_metric(self.count_query(step), start_ns + step_ns, end_ns, step)
+        if results is None:
+            return None
+
+        samples = []
+        for series in results:
+            labels = series.get('metric', {})
+            try:
+                server_id = labels['serverid']
+                project_key = labels['projectkey']
+                msg_type = int(labels['messagetypeid'])
+            except (KeyError, ValueError):
+                logger.warning(f"Incomplete count series: {labels}")
+                continue
+            for timestamp, value in series.get('values', []):
+                samples.append((server_id, project_key, msg_type,
+                                int(round(float(timestamp) * 1000)) * 1_000_000, int(float(value))))
+        samples.sort(key=lambda sample: sample[3])
+        return samples, end_ns
+
+    def apply_pulled_counts(self, pulled):
+        """Apply the result of fetch_counts(), returning the number of samples"""
+        if pulled is None:
+            return 0
+        samples, end_ns = pulled
+        with self.state_lock:
+            count = self.metrics_state.apply_counts(samples)
+            self.metrics_state.counted_until = end_ns
+        logger.info(f"Applied {count} message count samples from Loki")
+        return count
+
+    def _query_metric(self, query, start_time, end_time, step):
+        """Run a LogQL metric query over [start_time, end_time], returning the matrix result or None on failure"""
+        try:
+            logger.debug(f"Querying Loki with params: query={query}, start={start_time}, end={end_time}, step={step}")
+            params = {
+                'query': query,
+                'start': start_time,
+                'end': end_time,
+                'step': step,
+            }
+
+            with self.loki_slots, LOKI_REQUEST_SECONDS.labels('metric').time():
+                response = self.loki.get(self.query_endpoint, params=params, timeout=30)
+            response.raise_for_status()
+            data = json_loads(response.content)
+
+            if 'data' in data and 'result' in data['data']:
+                return data['data']['result']
+            else:
+                logger.warning("No results found in Loki response")
+                return []
+
+        except requests.exceptions.Timeout:
+            logger.error(f"Timeout while querying Loki endpoint: {self.query_endpoint}")
+            return None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to query Loki: {str(e)}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+            return None
+        except ValueError as e:
+            logger.error(f"Failed to decode Loki response: {str(e)}")
+            return None
+
+    def push_metrics(self, processed_count=0, error_count=0, pull=True):
+        """Run the unresponsive checks and push metrics to Prometheus (if the Pushgateway is a sink).
+        With aggregation pushdown the message counts are pulled first unless pull is False."""
+        if self.pushdown and pull:
+            self.pull_counts()
+
+        with self.state_lock:
+            self.metrics_state.check_timeouts()
+            if Config.INGEST_MODE == 'tail':
+                # A live connection never backfills, so streams silent for UNRESPONSIVE_TIMEOUT_MINUTES
+                # are forgotten here; measured from the newest entry, so nothing is pruned while
+                # disconnected and the reconnect backfill still starts where the tail stopped
+                if self.cursor.positions:
+                    newest = max(position[0] for position in self.cursor.positions.values())
+                    self.cursor.prune(newest - MetricsState._unresponsive_timeout_ns())
+                self.cursor.save(Config.CURSOR_FILE)
+
+        if (Config.CHECKPOINT_INTERVAL_SECONDS > 0
+                and time.monotonic() - self.last_checkpoint >= Config.CHECKPOINT_INTERVAL_SECONDS):
+            self.save_checkpoint()
+
+        self.update_reader_metrics()
+        if self.samples_queue is not None:
+            with self.state_lock:
+                samples = list(self.metrics_state.iter_samples())
+            # The coordinator exposes and pushes this worker's reader metrics too
+            self.samples_queue.put((self.shard[0], samples, list(READER_REGISTRY.collect())))
+            logger.info(f"Published {len(samples)} samples to the coordinator. Processed: {processed_count}, Errors: {error_count}")
+            return
+
+        if Config.METRICS_SINK == 'http':
+            logger.info(f"Metrics updated for scraping. Processed: {processed_count}, Errors: {error_count}")
+            return
+
+        try:
+            push_to_gateway(self.prometheus_url, job=Config.READER_JOB_NAME, registry=READER_REGISTRY,
+                            handler=self.pushgateway.push_handler)
+        except Exception as e:
+            logger.error(f"Failed to push reader metrics to Prometheus: {e}")
+
+        # Observed now and reported with the next push
+        started = time.perf_counter()
+        self.push_summary(processed_count, error_count)
+        CYCLE_STAGE_SECONDS.labels('push').observe(time.perf_counter() - started)
+
+    def update_reader_metrics(self):
+        """Refresh the reader's gauges of ingest lag, state size and circuit state"""
+        with self.state_lock:
+            newest = self.metrics_state.dedup.max_timestamp
+            sizes = self.metrics_state.state_sizes()
+        if newest:
+            INGEST_LAG.set(max(0.0, (time.time_ns() - newest) / 1_000_000_000))
+        for kind, size in sizes.items():
+            STATE_SIZE.labels(kind).set(size)
+        for client in (self.loki, self.pushgateway):
+            CIRCUIT_OPEN.labels(client.name).set(int(client.breaker.opened_at is not None))
+        LAST_CYCLE.set_to_current_time()
+
+    def push_summary(self, processed_count, error_count):
+        """Push the summary metrics, per changed project or as the whole registry (PUSH_MODE)"""
+        if Config.PUSH_MODE == 'grouped':
+            with self.state_lock:
+                groups = self.metrics_state.take_unpushed()
+            failed = self.pusher.push(groups)
+            if failed:
+                # Retried with the next push
+                with self.state_lock:
+                    self.metrics_state.unpushed_projects |= failed
+            logger.info(f"Pushed {len(groups) - len(failed)} of {len(groups)} changed projects to Prometheus. "
+                        f"Processed: {processed_count}, Errors: {error_count}")
+            return
+
+        try:
+            push_to_gateway(self.prometheus_url, job=Config.PROMETHEUS_JOB_NAME, registry=REGISTRY,
+                            handler=self.pushgateway.push_handler)
+            logger.info(f"Successfully pushed metrics to Prometheus. Processed: {processed_count}, Errors: {error_count}")
+        except Exception as e:
+            logger.error(f"Failed to push to Prometheus: {e}")
+
+    def get_logs(self, query, start_time, end_time, limit=5000):
+        """Query logs from Loki for [start_time, end_time) (nanosecond timestamps),
+        yielding LogEntry tuples in timestamp order.
+
+        Responses are decoded while they download and handed on page by page,
+        so memory is bounded by the page size rather than the window. A result
+        that comes back with `limit` entries is truncated: the rest of the window
+        is split into sub-ranges of about `limit` entries each, fetched on
+        MAX_WORKERS threads with at most MAX_WORKERS sub-ranges in flight, and
+        yielded in order as they complete.
+        """
+        cursor = StreamCursor()
+        first_page = self._fetch_page(query, start_time, end_time, limit, cursor)
+        if first_page is None:
+            return
+
+        streams, count, last_timestamp = first_page
+        total = count
+        if count < limit:
+            yield from heapq.merge(*streams)
+            logger.info(f"Found {total} log entries")
+            return
+
+        sub_ranges = self._split_range(start_time, last_timestamp, end_time, limit)
+        logger.info(f"Loki result truncated at {limit} entries, fetching the rest of the window "
+                    f"in {len(sub_ranges)} sub-range(s)")
+
+        # The first sub-range continues from the first page, so it reuses its cursor to
+        # skip entries at last_timestamp that were already returned
+        cursors = [cursor] + [StreamCursor() for _ in sub_ranges[1:]]
+        ranges = iter(zip(sub_ranges, cursors))
+        with ThreadPoolExecutor(max_workers=min(Config.MAX_WORKERS, len(sub_ranges))) as executor:
+            in_flight = deque()
+
+            def submit_next():
+                for (range_start, range_end), range_cursor in islice(ranges, 1):
+                    in_flight.append(executor.submit(
+                        self._fetch_range, query, range_start, range_end, limit, range_cursor
+                    ))
+
+            # Sub-ranges download while the first page is consumed
+            for _ in range(Config.MAX_WORKERS):
+                submit_next()
+            yield from heapq.merge(*streams)
+
+            while in_flight:
+                range_pages, complete = in_flight.popleft().result()
+                submit_next()
+                for streams, count in range_pages:
+                    total += count
+                    yield from heapq.merge(*streams)
+                # Stop at the first incomplete sub-range so no gap is skipped over
+                if not complete:
+                    logger.warning("Stopped reading Loki results at an incomplete sub-range")
+                    for future in in_flight:
+                        future.cancel()
+                    break
+
+        logger.info(f"Found {total} log entries")
+
+    def _split_range(self, start_time, last_timestamp, end_time, limit):
+        """Split [last_timestamp, end_time) into sub-ranges of about `limit` entries each,
+        estimating density from the page that covered [start_time, last_timestamp]"""
+        covered = max(last_timestamp - start_time, 1_000_000_000)
+        remaining = max(end_time - last_timestamp, 1)
+        parts = max(1, math.ceil(remaining / covered))
+
+        step = math.ceil(remaining / parts)
+        bounds = [last_timestamp + i * step for i in range(parts)] + [end_time]
+        return [(bounds[i], bounds[i + 1]) for i in range(parts) if bounds[i] < bounds[i + 1]]
+
+    def _fetch_range(self, query, start_time, end_time, limit, cursor):
+        """Fetch every page of [start_time, end_time).
+
+        Returns the list of pages, each (per-stream LogEntry lists, raw entry
+        count), and whether the range was read completely.
+        """
+        pages = []
+        while True:
+            page = self._fetch_page(query, start_time, end_time, limit, cursor)
+            if page is None:
+                return pages, False
+
+            streams, count, last_timestamp = page
+            pages.append((streams, count))
+            if count < limit:
+                return pages, True
+
+            if last_timestamp <= start_time:
+                # More than `limit` entries share one timestamp; move past it to make progress
+                logger.warning(f"More than {limit} entries at timestamp {start_time}, skipping the rest of them")
+                last_timestamp = start_time + 1
+            start_time = last_timestamp
+
+    def _fetch_page(self, query, start_time, end_time, limit, cursor):
+        """Run one query, decoding entries as the response downloads, and drop
+        entries the cursor has already seen.
+
+        Returns (per-stream LogEntry lists, raw entry count, last timestamp) or
+        None on failure.
+        """
+        timeout = self._request_timeout()
+        if timeout is None:
+            logger.warning("Cycle deadline reached, leaving the rest of the window for the next cycle")
+            return None
+
+        cursor.begin()
+        count = 0
+        last_timestamp = start_time
+        streams = {}
+        parse_errors = 0
+        parse_seconds = 0.0
+        bytes_read = 0
+        perf_counter = time.perf_counter
+        try:
+            with self.loki_slots:
+                response = self._query_range(query, start_time, end_time, limit, timeout)
+                if response is None:
+                    return None
+                with response:
+                    parser = LokiResponseParser(response.iter_content(chunk_size=64 * 1024))
+                    labels = stream_key = None
+                    for entry_labels, timestamp, log_line in parser.entries():
+                        if entry_labels is not labels:
+                            labels = entry_labels
+                            stream_key = StreamCursor.stream_key(labels)
+                        count += 1
+                        timestamp = int(timestamp)
+                        last_timestamp = max(last_timestamp, timestamp)
+                        if not cursor.accept(stream_key, timestamp):
+                            continue
+                        decode_started = perf_counter()
+                        entry = self._decode_entry(timestamp, stream_key, log_line)
+                        parse_seconds += perf_counter() - decode_started
+                        if entry is None:
+                            parse_errors += 1
+                            continue
+                        streams.setdefault(stream_key, []).append(entry)
+                    # Read the trailing stats so the connection goes back to the pool
+                    parser.drain()
+                    bytes_read = response.raw.tell()
+
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to read Loki response: {str(e)}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+            return None
+        except ValueError as e:
+            logger.error(f"Failed to decode Loki response: {str(e)}")
+            return None
+
+        self.cycle_stats.add(lines=count, bytes_read=bytes_read, parse_seconds=parse_seconds)
+        LINES_READ.inc(count)
+        BYTES_READ.inc(bytes_read)
+        if count >= limit:
+            TRUNCATED_RESPONSES.inc()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Retrieved {count} entries in {len(streams)} streams from Loki")
+        if parse_errors > 0:
+            PARSE_ERRORS.inc(parse_errors)
+            logger.warning(f"Encountered {parse_errors} parsing errors while processing {count} logs")
+        return list(streams.values()), count, last_timestamp
+
+    def _request_timeout(self):
+        """Timeout for the next Loki request: 30 s, cut to what is left before the
+        cycle deadline; None once the deadline has passed"""
+        if self.cycle_deadline is None:
+            return 30
+        remaining = self.cycle_deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return min(30, remaining)
+
+    def _query_range(self, query, start_time, end_time, limit, timeout=30):
+        """Start a single query_range request, returning the streaming response or None on failure"""
+        try:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Querying Loki with params: query={query}, start={start_time}, end={end_time}, limit={limit}")
+            params = {
+                'query': query,
+                'start': start_time,
+                'end': end_time,
+                'limit': limit,
+                'direction': 'forward',
+            }
+
+            with LOKI_REQUEST_SECONDS.labels('range').time():
+                response = self.loki.get(self.query_endpoint, params=params, timeout=timeout, stream=True)
+            if not response.ok:
+                response.close()
+            response.raise_for_status()
+            return response
+        
+        except requests.exceptions.Timeout:
+            logger.error(f"Timeout while querying Loki endpoint: {self.query_endpoint}")
+            return None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to query Loki: {str(e)}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+            return None
+        except Exception as e:
+            logger.error(f"Unexpected error querying Loki: {str(e)}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+            return None
+
+    def _parse_results(self, results):
+        """Parse Loki results into a single iterator of LogEntry tuples in timestamp order.
+
+        Each stream's values are already in time order, so the streams are merged
+        lazily on a heap (k-way merge) instead of being flattened and sorted.
+        """
+        counts = {'parsed': 0, 'errors': 0}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Parsing {len(results)} result streams")
+
+        yield from heapq.merge(*(self._parse_stream(stream, counts) for stream in results))
+
+        LINES_READ.inc(counts['parsed'] + counts['errors'])
+        if counts['errors'] > 0:
+            PARSE_ERRORS.inc(counts['errors'])
+            logger.warning(f"Encountered {counts['errors']} parsing errors while processing {counts['parsed']} logs")
+        else:
+            logger.info(f"Successfully parsed {counts['parsed']} logs without errors")
+
+    def _parse_stream(self, stream, counts):
+        """Decode the entries of one result stream, keeping only the ActivityLog fields"""
+        labels = stream.get('stream', {})
+        values = stream.get('values', [])
+        stream_key = StreamCursor.stream_key(labels)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Processing stream with labels: {labels}, containing {len(values)} values")
+
+        for value in values:
+            try:
+                timestamp, log_line = value
+                entry = self._decode_entry(int(timestamp), stream_key, log_line)
+            except Exception as e:
+                if event_log_sampler.allow('value_error'):
+                    logger.error(f"Error processing log value: {str(e)}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Problematic value: {value}")
+                entry = None
+
+            if entry is None:
+                counts['errors'] += 1
+                continue
+            counts['parsed'] += 1
+            yield entry
+
+    @staticmethod
+    def _decode_entry(timestamp, stream_key, log_line):
+        """Decode one log line to a LogEntry, or None if it is not an ActivityLog JSON object"""
+        try:
+            fields = activity_fields(json_loads(body_json(log_line)))
+            return LogEntry(timestamp, stream_key, EventDeduplicator.event_key(stream_key, timestamp, log_line), *fields)
+        except (ValueError, AttributeError) as e:
+            if event_log_sampler.allow('invalid_json'):
+                logger.warning(f"Failed to parse JSON log entry at timestamp {timestamp}: {str(e)}")
+            return None
+
+class ShardCoordinator:
+    """Runs SHARDS worker processes, each ingesting a disjoint crc32(projectkey)
+    partition into its own MetricsState, and merges the samples they publish
+    every cycle into one /metrics exposition or Pushgateway push.
+
+    Workers that exit are restarted; they resume from their own checkpoint.
+    """
+
+    def __init__(self, shard_count):
+        self.shard_count = shard_count
+        self.context = multiprocessing.get_context('spawn')
+        self.samples_queue = self.context.Queue()
+        self.workers = {}
+        self.shard_samples = {}
+        self.lock = threading.Lock()
+        self.registry = CollectorRegistry()
+        self.registry.register(self)
+        self.shard_reader_metrics = {}  # shard index -> the worker's reader metric families
+        self.reader_registry = CollectorRegistry()
+        self.reader_registry.register(ShardReaderCollector(self))
+        self.pushgateway = HttpClient('pushgateway', 1)
+        self.pusher = GroupedPusher(Config.PROMETHEUS_GATEWAY, self.pushgateway)
+        self.pushed_groups = {}  # project_key -> samples of its last successful grouped push
+        self._stop_event = threading.Event()
+        self._receiver = None
+
+    def start(self):
+        """Start the workers and the thread receiving their samples"""
+        for index in range(self.shard_count):
+            self._start_worker(index)
+        self._receiver = threading.Thread(target=self._receive, name='shard-receiver', daemon=True)
+        self._receiver.start()
+
+    def _start_worker(self, index):
+        process = self.context.Process(
+            target=run_shard, args=(index, self.shard_count, self.samples_queue),
+            name=f'loki-reader-shard-{index}', daemon=True
+        )
+        process.start()
+        self.workers[index] = process
+        logger.info(f"Started shard {index} worker (pid {process.pid})")
+
+    def ensure_workers(self):
+        """Restart any worker that has exited"""
+        for index, process in list(self.workers.items()):
+            if not process.is_alive():
+                logger.error(f"Shard {index} worker exited with code {process.exitcode}, restarting")
+                self._start_worker(index)
+
+    def _receive(self):
+        while not self._stop_event.is_set():
+            try:
+                index, samples, reader_metrics = self.samples_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                self.shard_samples[index] = samples
+                self.shard_reader_metrics[index] = reader_metrics
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        with self.lock:
+            shard_samples = list(self.shard_samples.values())
+        return metric_families(sample for samples in shard_samples for sample in samples)
+
+    def push(self):
+        """Push the workers' reader metrics and the merged samples of all shards to
+        the Pushgateway. In grouped mode only the projects whose samples changed are pushed."""
+        try:
+            push_to_gateway(Config.PROMETHEUS_GATEWAY, job=Config.READER_JOB_NAME, registry=self.reader_registry,
+                            handler=self.pushgateway.push_handler)
+        except Exception as e:
+            logger.error(f"Failed to push reader metrics to Prometheus: {e}")
+
+        if Config.PUSH_MODE == 'grouped':
+            with self.lock:
+                shard_samples = list(self.shard_samples.values())
+            groups = group_by_project(sample for samples in shard_samples for sample in samples)
+            changed = {project_key: samples for project_key, samples in groups.items()
+                       if self.pushed_groups.get(project_key) != samples}
+            changed.update((project_key, []) for project_key in self.pushed_groups if project_key not in groups)
+            failed = self.pusher.push(changed)
+            for project_key, samples in changed.items():
+                if project_key in failed:
+                    continue
+                if samples:
+                    self.pushed_groups[project_key] = samples
+                else:
+                    self.pushed_groups.pop(project_key, None)
+            logger.info(f"Pushed {len(changed) - len(failed)} of {len(changed)} changed projects of "
+                        f"{len(shard_samples)} shards to Prometheus")
+            return
+
+        try:
+            push_to_gateway(Config.PROMETHEUS_GATEWAY, job=Config.PROMETHEUS_JOB_NAME, registry=self.registry,
+                            handler=self.pushgateway.push_handler)
+            logger.info(f"Successfully pushed metrics of {len(self.shard_samples)} shards to Prometheus")
+        except Exception as e:
+            logger.error(f"Failed to push to Prometheus: {e}")
+
+    def stop(self, timeout=30):
+        """Stop the workers (each writes its final checkpoint) and the receiver"""
+        for process in self.workers.values():
+            process.terminate()
+        for process in self.workers.values():
+            process.join(timeout)
+        self._stop_event.set()
+
+class ShardReaderCollector:
+    """Collector of the reader metrics the shard workers publish, merged into
+    one family per metric with a `shard` label"""
+
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        with self.coordinator.lock:
+            shard_metrics = sorted(self.coordinator.shard_reader_metrics.items())
+        families = {}
+        for index, shard_families in shard_metrics:
+            shard = str(index)
+            for family in shard_families:
+                merged = families.get(family.name)
+                if merged is None:
+                    merged = families[family.name] = Metric(family.name, family.documentation, family.type, family.unit)
+                merged.samples.extend(
+                    sample._replace(labels={'shard': shard, **sample.labels}) for sample in family.samples
+                )
+        return iter(families.values())
+
+class OpenMetricsWriter:
+    """Writes a timeline of summary metric samples as an OpenMetrics file for
+    `promtool tsdb create-blocks-from openmetrics`.
+
+    OpenMetrics keeps each family's, and within it each series', samples
+    together, while a timeline arrives step by step. So each family's lines are
+    spooled to temporary files in runs sorted by series, which are merged on
+    close; both sorts are stable, so every series stays in time order.
+    """
+    RUN_SIZE = 100_000
+
+    def __init__(self, path):
+        self.path = path
+        self.buffers = {name: [] for name in METRIC_DEFINITIONS}
+        self.runs = {name: [] for name in METRIC_DEFINITIONS}
+        self.sample_count = 0
+
+    @staticmethod
+    def _escape(value):
+        return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    @staticmethod
+    def _series(line):
+        return line[:line.rindex('}')]
+
+    def write(self, samples, timestamp_ns):
+        """Append (name, label values, value) samples taken at timestamp_ns"""
+        seconds = f"{timestamp_ns / 1_000_000_000:.3f}"
+        for name, label_values, value in samples:
+            labels = ','.join(
+                f'{label}="{self._escape(label_value)}"'
+                for label, label_value in zip(METRIC_DEFINITIONS[name][1], label_values)
+            )
+            buffer = self.buffers[name]
+            buffer.append(f"{name}{{{labels}}} {value} {seconds}\n")
+            if len(buffer) >= self.RUN_SIZE:
+                self._spill(name)
+            self.sample_count += 1
+
+    def _spill(self, name):
+        buffer = self.buffers[name]
+        buffer.sort(key=self._series)
+        run = tempfile.TemporaryFile('w+')
+        run.writelines(buffer)
+        run.seek(0)
+        self.runs[name].append(run)
+        buffer.clear()
+
+    def close(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as out:
+            for name, runs in self.runs.items():
+                out.write(f"# HELP {name} {METRIC_DEFINITIONS[name][0]}\n# TYPE {name} gauge\n")
+                buffer = sorted(self.buffers[name], key=self._series)
+                out.writelines(heapq.merge(*runs, buffer, key=self._series))
+                for run in runs:
+                    run.close()
+                self.buffers[name] = []
+            out.write("# EOF\n")
+        os.replace(tmp_path, self.path)
+
+class Replayer:
+    """Rebuilds the metric timeline of a past time range from Loki.
+
+    [start - warmup, end) is fetched in chunks of REPLAY_CHUNK_MINUTES, up to
+    MAX_WORKERS chunks in parallel, and streamed in timestamp order into a fresh
+    MetricsState driven by an EventClock. Every `step` from start on, the
+    timeouts are applied at that instant and every series is written out with
+    the step's timestamp. The warm-up lets servers that were already running
+    at start show their real status.
+    """
+
+    # Entries are handed from the fetch threads in batches, at most BUFFERED_BATCHES per chunk
+    BATCH_SIZE = 5000
+    BUFFERED_BATCHES = 4
+
+    def __init__(self, reader, step_seconds, warmup_hours):
+        self.reader = reader
+        self.step_ns = step_seconds * 1_000_000_000
+        self.warmup_ns = int(warmup_hours * 60 * 60 * 1_000_000_000)
+
+    def run(self, start_ns, end_ns, output_path):
+        """Replay [start_ns, end_ns) and write the timeline to output_path"""
+        started = time.monotonic()
+        fetch_start = start_ns - self.warmup_ns
+        clock = EventClock(fetch_start)
+        state = MetricsState(clock)
+        # Raw lines are replayed, and nothing is written to the live gauges or pushed
+        state.count_events = True
+        state.write_gauges = False
+        state.track_pushes = False
+        state.batching = True
+        writer = OpenMetricsWriter(output_path)
+        counts = {'skipped': 0, 'errors': 0}
+        processed = 0
+        next_step = start_ns
+
+        entries = self._fetch_chunks(Config.LOKI_QUERY, fetch_start, end_ns)
+        for event in self.reader._iter_events(entries, False, counts):
+            timestamp = event[3]
+            # A step's samples reflect every event before it
+            while next_step <= timestamp and next_step < end_ns:
+                self._write_step(state, clock, writer, next_step)
+                next_step += self.step_ns
+            clock.advance(timestamp)
+            state.update_metrics(*event)
+            processed += 1
+
+        while next_step < end_ns:
+            self._write_step(state, clock, writer, next_step)
+            next_step += self.step_ns
+        writer.close()
+        logger.info(f"Replayed {processed} log entries ({counts['errors']} errors) into {writer.sample_count} "
+                    f"samples in {output_path} in {time.monotonic() - started:.1f}s")
+        return processed, writer.sample_count
+
+    @staticmethod
+    def _write_step(state, clock, writer, timestamp):
+        clock.advance(timestamp)
+        state.check_timeouts()
+        state.flush()
+        writer.write(state.iter_samples(), timestamp)
+
+    def _fetch_chunks(self, query, start_ns, end_ns):
+        """Yield the entries of [start_ns, end_ns) in order, chunk by chunk.
+
+        Up to MAX_WORKERS chunks download ahead, each into its own bounded
+        queue of batches, so memory stays bounded however dense a chunk is.
+        """
+        chunk_ns = Config.REPLAY_CHUNK_MINUTES * 60 * 1_000_000_000
+        chunks = [(chunk_start, min(chunk_start + chunk_ns, end_ns))
+                  for chunk_start in range(start_ns, end_ns, chunk_ns)]
+        pending = iter(chunks)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=Config.MAX_WORKERS) as executor:
+            in_flight = deque()
+
+            def submit_next():
+                for chunk_start, chunk_end in islice(pending, 1):
+                    batches = queue.Queue(maxsize=self.BUFFERED_BATCHES)
+                    future = executor.submit(self._fetch_chunk, query, chunk_start, chunk_end, batches, stop)
+                    in_flight.append((future, batches))
+
+            try:
+                for _ in range(Config.MAX_WORKERS):
+                    submit_next()
+                for index in range(len(chunks)):
+                    future, batches = in_flight.popleft()
+                    submit_next()
+                    count = 0
+                    while True:
+                        batch = batches.get()
+                        if batch is None:
+                            break
+                        count += len(batch)
+                        yield from batch
+                    future.result()
+                    logger.info(f"Replayed chunk {index + 1}/{len(chunks)} with {count} entries")
+            finally:
+                # Release fetch threads blocked on a full queue if the replay stops early
+                stop.set()
+
+    def _fetch_chunk(self, query, start_ns, end_ns, batches, stop):
+        """Fetch one chunk into batches, ending with None"""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            logs = self.reader.get_logs(query, start_ns, end_ns)
+            while True:
+                batch = list(islice(logs, self.BATCH_SIZE))
+                if not batch or not put(batch):
+                    break
+        finally:
+            put(None)
+
+def parse_time(value):
+    """Parse an RFC 3339 timestamp or Unix seconds to nanoseconds"""
+    try:
+        return int(float(value) * 1_000_000_000)
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value!r}")
+    if parsed.tzinfo is None:
+        parsed = pytz.utc.localize(parsed)
+    return round(parsed.timestamp() * 1_000_000) * 1000
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize ActivityLog entries from Loki into Prometheus metrics')
+    subparsers = parser.add_subparsers(dest='command')
+    replay = subparsers.add_parser(
+        'replay', help='Rebuild the metric timeline of a past range as an OpenMetrics backfill file'
+    )
+    replay.add_argument('--from', dest='start', type=parse_time, required=True,
+                        help='Start of the range (RFC 3339 or Unix seconds)')
+    replay.add_argument('--to', dest='end', type=parse_time, required=True,
+                        help='End of the range (RFC 3339 or Unix seconds)')
+    replay.add_argument('--output', default='backfill.om', help='OpenMetrics file to write')
+    replay.add_argument('--step', type=int, default=Config.PUSH_INTERVAL_SECONDS,
+                        help='Seconds between samples of the timeline')
+    replay.add_argument('--warmup-hours', type=float, default=Config.RESET_TIMEOUT_HOURS,
+                        help='Hours of logs before --from replayed to establish server state')
+    args = parser.parse_args(argv)
+    if args.command == 'replay' and args.end <= args.start:
+        parser.error('--to must be after --from')
+    return args
+
+def run_replay(args):
+    """Entry point of the replay command"""
+    # Progress goes to the console; the live checkpoint and cursor are left alone
+    Config.ENABLE_CONSOLE_LOG = True
+    Config.setup_logging()
+    Config.CHECKPOINT_INTERVAL_SECONDS = 0
+    reader = LokiLogReader()
+    Replayer(reader, args.step, args.warmup_hours).run(args.start, args.end, args.output)
+    logger.info(f"Backfill with: promtool tsdb create-blocks-from openmetrics {args.output} <data dir>")
+
+def run_shard(index, shard_count, samples_queue):
+    """Entry point of a shard worker process"""
+    # Each shard keeps its own logs, cursor and checkpoint
+    Config.LOG_DIR = os.path.join(Config.LOG_DIR, f'shard-{index}')
+    Config.setup_logging()
+    Config.STATE_DIR = os.path.join(Config.STATE_DIR, f'shard-{index}')
+    Config.CURSOR_FILE = os.path.join(Config.STATE_DIR, 'cursor.json')
+    Config.CHECKPOINT_FILE = os.path.join(Config.STATE_DIR, 'checkpoint.json')
+    # The coordinator exposes and pushes the metrics, so no gauges are written here
+    Config.METRICS_SINK = 'http'
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        run_reader(LokiLogReader(shard=(index, shard_count), samples_queue=samples_queue))
+    except Exception as e:
+        logger.critical(f"Fatal error in shard {index}: {str(e)}")
+        logger.debug(f"Stack trace: {traceback.format_exc()}")
+        sys.exit(1)
+
+def handle_sigterm(signum, frame):
+    # Kubernetes stops pods with SIGTERM; shut down like on Ctrl+C so the
+    # final checkpoint is written
+    raise KeyboardInterrupt
+
+def run_cycles(reader):
+    """Process logs and push metrics every PUSH_INTERVAL_SECONDS until interrupted"""
+    consecutive_errors = 0
+    max_consecutive_errors = 3
+
+    # Process logs every minute
+    while True:
+        try:
+            if Config.INGEST_MODE in ('tail', 'otlp'):
+                reader.push_metrics()
+            else:
+                reader.process_logs(minutes=Config.UNRESPONSIVE_TIMEOUT_MINUTES)
+            if consecutive_errors > 0:
+                logger.info(f"Successfully recovered after {consecutive_errors} errors")
+                consecutive_errors = 0
+            logger.info("Completed log processing cycle")
+            time.sleep(Config.PUSH_INTERVAL_SECONDS)  # Wait before next processing
+
+        except KeyboardInterrupt:
+            shutdown_reader(reader)
+            break
+
+        except Exception as e:
+            consecutive_errors += 1
+            logger.error(f"Error in main loop (attempt {consecutive_errors}): {str(e)}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+
+            if consecutive_errors >= max_consecutive_errors:
+                logger.critical(f"Service stopping after {consecutive_errors} consecutive errors")
+                sys.exit(1)
+
+            # Exponential backoff for retries
+            sleep_time = min(60 * (2 ** (consecutive_errors - 1)), 300)  # Max 5 minutes
+            logger.info(f"Retrying in {sleep_time} seconds...")
+            time.sleep(sleep_time)
+
+def shutdown_reader(reader):
+    logger.info("Received shutdown signal, stopping service...")
+    if reader.tail_stream:
+        reader.tail_stream.stop()
+    if reader.otlp_receiver:
+        reader.otlp_receiver.stop()
+    if Config.CHECKPOINT_INTERVAL_SECONDS > 0:
+        reader.save_checkpoint()
+    reader.loki.close()
+    reader.pushgateway.close()
+
+async def run_cycles_async(reader):
+    """Start a cycle every PUSH_INTERVAL_SECONDS on the monotonic clock, without drift.
+
+    Blocking work runs in threads: the log fetch and (with aggregation pushdown)
+    the count query run concurrently, the counts being applied after the logs,
+    and each push runs in the background while the next cycle waits and fetches.
+    Fetching stops at the cycle deadline; a cycle that overruns its interval makes
+    the schedule skip the missed ticks.
+    """
+    loop = asyncio.get_running_loop()
+    interval = Config.PUSH_INTERVAL_SECONDS
+    deadline = Config.CYCLE_DEADLINE_SECONDS or interval
+    fetches_logs = Config.INGEST_MODE in ('window', 'cursor')
+    consecutive_errors = 0
+    max_consecutive_errors = 3
+    push_task = None
+    next_tick = loop.time()
+
+    while True:
+        try:
+            fetches = []
+            if fetches_logs:
+                reader.cycle_deadline = time.monotonic() + deadline
+                fetches.append(asyncio.to_thread(reader.ingest_cycle, Config.UNRESPONSIVE_TIMEOUT_MINUTES))
+            if reader.pushdown:
+                fetches.append(asyncio.to_thread(reader.fetch_counts))
+            results = await asyncio.gather(*fetches)
+            processed_count, error_count = results[0] if fetches_logs else (0, 0)
+            if reader.pushdown:
+                # Only now that the cycle's status lines are ingested (see fetch_counts)
+                await asyncio.to_thread(reader.apply_pulled_counts, results[-1])
+
+            # Pushes are serialized: the previous one has to finish first
+            if push_task is not None:
+                await push_task
+            push_task = asyncio.create_task(
+                asyncio.to_thread(reader.push_metrics, processed_count, error_count, False)
+            )
+
+            if consecutive_errors > 0:
+                logger.info(f"Successfully recovered after {consecutive_errors} errors")
+                consecutive_errors = 0
+            logger.info("Completed log processing cycle")
+
+        except Exception as e:
+            if push_task is not None:
+                # Keep pushes serialized: the pending push has to finish before the next one
+                await asyncio.wait([push_task])
+                push_error = push_task.exception()
+                if push_error is not None and push_error is not e:
+                    logger.error(f"Background push failed: {push_error}")
+                push_task = None
+            consecutive_errors += 1
+            logger.error(f"Error in main loop (attempt {consecutive_errors}): {str(e)}")
+            logger.debug(f"Stack trace: {traceback.format_exc()}")
+
+            if consecutive_errors >= max_consecutive_errors:
+                logger.critical(f"Service stopping after {consecutive_errors} consecutive errors")
+                sys.exit(1)
+
+        next_tick += interval
+        now = loop.time()
+        if next_tick <= now:
+            skipped = int((now - next_tick) // interval) + 1
+            next_tick += skipped * interval
+            logger.warning(f"Cycle overran the {interval}s interval, skipping {skipped} tick(s)")
+        await asyncio.sleep(next_tick - now)
+
+def run_reader(reader):
+    """Run the reader's cycles on the configured runtime until interrupted"""
+    if Config.RUNTIME != 'asyncio':
+        run_cycles(reader)
+        return
+    try:
+        asyncio.run(run_cycles_async(reader))
+    except KeyboardInterrupt:
+        shutdown_reader(reader)
+
+def run_sharded():
+    """Run SHARDS worker processes and merge their metrics"""
+    coordinator = ShardCoordinator(Config.SHARDS)
+    coordinator.start()
+    if Config.METRICS_SINK in ('http', 'both'):
+        pull_registry = CollectorRegistry()
+        pull_registry.register(coordinator)
+        pull_registry.register(coordinator.reader_registry)
+        start_http_server(Config.METRICS_PORT, registry=pull_registry)
+        logger.info(f"Serving merged shard metrics on port {Config.METRICS_PORT}")
+
+    while True:
+        try:
+            time.sleep(Config.PUSH_INTERVAL_SECONDS)
+            coordinator.ensure_workers()
+            if Config.METRICS_SINK != 'http':
+                coordinator.push()
+        except KeyboardInterrupt:
+            logger.info("Received shutdown signal, stopping shard workers...")
+            coordinator.stop()
+            break
+
+def main():
+    args = parse_args()
+    try:
+        if args.command == 'replay':
+            run_replay(args)
+            return
+
+        logger.info("Starting Loki Reader service")
+        logger.info(f"Configuration: Log level={Config.LOG_LEVEL}, Loki Server={Config.LOKI_SERVER_HOST}:{Config.LOKI_SERVER_PORT}")
+        logger.info(f"Prometheus Gateway: {Config.PROMETHEUS_GATEWAY}")
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+        if Config.SHARDS > 1:
+            if Config.INGEST_MODE in ('window', 'cursor'):
+                logger.info(f"Running {Config.SHARDS} shard workers partitioned by projectkey")
+                run_sharded()
+                return
+            logger.warning("SHARDS is only supported in window and cursor mode, running a single reader")
+        
+        reader = LokiLogReader()
+
+        if Config.METRICS_SINK in ('http', 'both'):
+            reader.start_metrics_server()
 
-                if consecutive_errors >= max_consecutive_errors:
-                    logger.critical(f"Service stopping after {consecutive_errors} consecutive errors")
-                    sys.exit(1)
+        # In tail and otlp mode entries arrive continuously; the loop only pushes
+        if Config.INGEST_MODE == 'tail':
+            reader.tail_stream = LokiTailStream(reader)
+            reader.tail_stream.start()
+        elif Config.INGEST_MODE == 'otlp':
+            reader.otlp_receiver = OtlpLogsReceiver(reader)
+            reader.otlp_receiver.start()
 
-                # Exponential backoff for retries
-                sleep_time = min(60 * (2 ** (consecutive_errors - 1)), 300)  # Max 5 minutes
-                logger.info(f"Retrying in {sleep_time} seconds...")
-                time.sleep(sleep_time)
+        run_reader(reader)
 
     except Exception as e:
         logger.critical(f"Fatal error in main process: {str(e)}")
@@ -600,4 +3225,4 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
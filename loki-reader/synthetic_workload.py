@@ -0,0 +1,129 @@
+"""
+Seeded generator of synthetic ActivityLog workloads.
+
+Produces complete ActivityLog bodies (every field of `Supported Logs
+format.txt`) for a fleet of servers spread over projects, with a configurable
+message type mix. The same seed always yields the same workload, so benchmark
+runs are comparable.
+
+Every server announces itself with a start (type 1) before its other events,
+and a server that stopped (type 3) starts again before it sends anything else.
+
+    python synthetic_workload.py --servers 1000 --projects 50 --events 100000 --seed 1 > workload.jsonl
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+# messagetypeid -> relative weight
+DEFAULT_MIX = {5: 90, 15: 8, 3: 1, 1: 1}
+
+TIME_ZONES = ['US/Central', 'US/Eastern', 'Europe/Berlin', 'Asia/Jerusalem']
+
+
+def parse_mix(value):
+    """Parse a message type mix like `5=90,15=8,3=1,1=1`"""
+    try:
+        mix = {int(msg_type): float(weight)
+               for msg_type, weight in (part.split('=') for part in value.split(','))}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid mix: {value!r}")
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError(f"invalid mix: {value!r}")
+    return mix
+
+
+class SyntheticWorkload:
+    def __init__(self, servers=10, projects=None, mix=None, seed=0, start_ns=None, rate=1000.0):
+        self.random = random.Random(seed)
+        projects = projects or max(1, servers // 20)
+        self.servers = [(server_id, f"project{server_id % projects}") for server_id in range(servers)]
+        self.mix = mix or DEFAULT_MIX
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.interval_ns = max(1, int(1_000_000_000 / rate))
+        self.time_zones = {server_id: self.random.choice(TIME_ZONES) for server_id, _ in self.servers}
+
+    def events(self, count):
+        """Yield `count` (timestamp, server_id, project_key, msg_type) events in timestamp order"""
+        msg_types = list(self.mix)
+        weights = list(self.mix.values())
+        started = set()
+        for index in range(count):
+            timestamp = self.start_ns + index * self.interval_ns
+            if index < len(self.servers):
+                server_id, project_key = self.servers[index]
+                msg_type = 1
+            else:
+                server_id, project_key = self.servers[self.random.randrange(len(self.servers))]
+                msg_type = self.random.choices(msg_types, weights)[0]
+                if server_id not in started:
+                    msg_type = 1
+            if msg_type == 3:
+                started.discard(server_id)
+            else:
+                started.add(server_id)
+            yield timestamp, server_id, project_key, msg_type
+
+    def payload(self, timestamp, server_id, project_key, msg_type):
+        """Full ActivityLog body for one event"""
+        created = datetime.fromtimestamp(timestamp / 1_000_000_000, tz=timezone.utc)
+        flow_id = self.random.randrange(1, 200) if msg_type == 5 else 0
+        return {
+            '_class': 'com.magicsoftware.xpi.info.data.ActivityLog',
+            'blobexists': 0,
+            'bpid': 0,
+            'category': ' ',
+            'createTimeStamp': created.strftime('%Y-%m-%dT%H:%M:%S.') + f"{created.microsecond // 1000:03d}Z",
+            'createdTimeInNanoSec': timestamp,
+            'dateOfWritingToSpace': {},
+            'extension': ' ',
+            'filelocation': ' ',
+            'flowid': flow_id,
+            'flowrequestid': self.random.randrange(1, 1_000_000) if flow_id else 0,
+            'fsid': 0,
+            'fsstep': 0,
+            'messagestring': 'Flow execution failed' if msg_type == 15 else ' ',
+            'messagetypeid': msg_type,
+            'objectlevel': 2,
+            'projectkey': project_key,
+            'rootfsId': 0,
+            'runId': str(uuid.UUID(int=self.random.getrandbits(128), version=4)),
+            'serverid': server_id,
+            'severity': 2 if msg_type == 15 else 0,
+            'statuscode': 0,
+            'timeZone': self.time_zones[server_id],
+            'userblob': None,
+            'usercode': 0,
+            'userkey1': ' ',
+            'userkey2': ' ',
+            'versionkey': ' ',
+        }
+
+    def lines(self, count):
+        """Yield `count` (timestamp, ActivityLog JSON line) pairs"""
+        for event in self.events(count):
+            yield event[0], json.dumps(self.payload(*event), separators=(',', ':'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a seeded synthetic ActivityLog workload as JSON lines')
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--projects', type=int, default=None, help='default: servers / 20')
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='messagetypeid weights, e.g. 5=90,15=8,3=1,1=1')
+    parser.add_argument('--rate', type=float, default=1000, help='events per second of log time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workload = SyntheticWorkload(args.servers, args.projects, args.mix, args.seed, rate=args.rate)
+    for timestamp, line in workload.lines(args.events):
+        sys.stdout.write(json.dumps({'timestamp': timestamp, 'line': line}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
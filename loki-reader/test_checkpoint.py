@@ -0,0 +1,93 @@
+"""
+Checkpoint restore against fake_loki.py: the replay of the gap since the checkpoint.
+
+    python -m pytest test_checkpoint.py
+"""
+import os
+import tempfile
+import time
+
+# Keep the tests away from the service's logs
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'loki-reader-tests'))
+
+import pytest
+
+from fake_loki import FakeLoki, activity_log
+from loki_reader import Config, EventClock, LokiLogReader, ServerSession, StatusMapping
+
+LABELS = {'app': 'otel-collector', 'pod': 'collector-0'}
+MINUTE_NS = 60 * 1_000_000_000
+
+
+@pytest.fixture
+def loki(monkeypatch, tmp_path):
+    fake = FakeLoki().start()
+    monkeypatch.setattr(Config, 'LOKI_SERVER_HOST', fake.host)
+    monkeypatch.setattr(Config, 'LOKI_SERVER_PORT', fake.port)
+    monkeypatch.setattr(Config, 'INGEST_MODE', 'window')
+    monkeypatch.setattr(Config, 'METRICS_SINK', 'http')
+    monkeypatch.setattr(Config, 'CHECKPOINT_INTERVAL_SECONDS', 300)
+    monkeypatch.setattr(Config, 'CHECKPOINT_FILE', str(tmp_path / 'checkpoint.json'))
+    yield fake
+    fake.stop()
+
+
+def push_log(loki, server_id, msg_type, timestamp):
+    loki.push(LABELS, activity_log(server_id, 'project', msg_type, timestamp), timestamp)
+
+
+def session(reader, server_id):
+    return reader.metrics_state.server_sessions[server_id]
+
+
+def test_checkpoint_round_trip_restores_sessions_dedup_and_cursor(loki):
+    now = time.time_ns()
+    reader = LokiLogReader()
+    state = reader.metrics_state
+    state.update_metrics('server', 'project', 1, now - 3 * MINUTE_NS, event_key=1)
+    state.update_metrics('server', 'project', 5, now - 2 * MINUTE_NS, event_key=2)
+    state.update_metrics('server', 'project', 15, now - MINUTE_NS, event_key=3)
+    state.update_metrics('stopped', 'other', 3, now - MINUTE_NS, event_key=4)
+    reader.cursor.positions = {'stream': [now - MINUTE_NS, 2]}
+    reader.save_checkpoint()
+
+    restored = LokiLogReader()
+    assert restored.metrics_state.snapshot() == state.snapshot()
+    assert restored.cursor.positions == {'stream': [now - MINUTE_NS, 2]}
+    assert restored.replay_from_ns == state.dedup.watermark
+
+    session = restored.metrics_state.server_sessions['server']
+    assert (session.status, session.flow_count, session.error_count) == (StatusMapping.ERROR, 1, 1)
+    assert session.window.count(now, ServerSession.FLOWS) == 1
+    assert restored.metrics_state.server_sessions['stopped'].status == StatusMapping.STOPPED
+    assert set(restored.metrics_state.project_servers) == {'project', 'other'}
+    # Replayed entries the checkpoint already counted are skipped
+    restored.metrics_state.update_metrics('server', 'project', 5, now - 2 * MINUTE_NS, event_key=2)
+    assert session.flow_count == 1
+
+
+def test_replayed_gap_keeps_servers_active_through_it_running(loki):
+    now = time.time_ns()
+    push_log(loki, 'busy', 1, now - 21 * MINUTE_NS)
+    push_log(loki, 'quiet', 1, now - 21 * MINUTE_NS)
+    reader = LokiLogReader()
+    assert reader.replay_from_ns is None
+    # Checkpointed right after the servers started, 21 minutes ago
+    reader.metrics_state.clock = EventClock(now - 21 * MINUTE_NS)
+    reader.ingest_cycle(minutes=30)
+    reader.save_checkpoint()
+    assert session(reader, 'busy').status == StatusMapping.RUNNING
+
+    # Written while the reader was down: a flow every 30 seconds for 20 minutes
+    for offset in range(40):
+        push_log(loki, 'busy', 5, now - 20 * MINUTE_NS + offset * MINUTE_NS // 2)
+
+    restored = LokiLogReader()
+    assert restored.replay_from_ns is not None
+    restored.ingest_cycle(minutes=5)
+
+    assert session(restored, 'busy').flow_count == 40
+    assert session(restored, 'busy').status == StatusMapping.RUNNING
+    # A server silent since before the checkpoint still times out on the wall clock
+    assert session(restored, 'quiet').status == StatusMapping.UNRESPONSIVE
+    assert restored.metrics_state.catch_up_clock is None
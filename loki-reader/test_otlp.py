@@ -0,0 +1,107 @@
+"""
+OTLP/HTTP logs receiver: decoding of ExportLogsServiceRequest bodies.
+
+    python -m pytest test_otlp.py
+"""
+import gzip
+import json
+import os
+import tempfile
+import time
+
+# Keep the tests away from the service's logs
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'loki-reader-tests'))
+
+import pytest
+import requests
+
+from loki_reader import Config, LokiLogReader, OtlpLogsReceiver
+
+SECOND_NS = 1_000_000_000
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    monkeypatch.setattr(Config, 'INGEST_MODE', 'otlp')
+    monkeypatch.setattr(Config, 'METRICS_SINK', 'http')
+    monkeypatch.setattr(Config, 'CHECKPOINT_INTERVAL_SECONDS', 0)
+    otlp = OtlpLogsReceiver(LokiLogReader(), host='127.0.0.1', port=0)
+    otlp.start()
+    yield otlp
+    otlp.stop()
+
+
+def activity(server_id, msg_type):
+    return {'serverid': server_id, 'projectkey': 'project', 'messagetypeid': msg_type}
+
+
+def kvlist(values):
+    return {'kvlistValue': {'values': [
+        {'key': key, 'value': {'intValue': str(value)} if isinstance(value, int) else {'stringValue': value}}
+        for key, value in values.items()
+    ]}}
+
+
+def export_request(*records):
+    return {'resourceLogs': [{'scopeLogs': [{'logRecords': list(records)}]}]}
+
+
+def post(receiver, body, **headers):
+    return requests.post(f'http://127.0.0.1:{receiver.port}/v1/logs', data=body, headers=headers, timeout=5)
+
+
+def sessions(receiver):
+    with receiver.reader.state_lock:
+        return dict(receiver.reader.metrics_state.server_sessions)
+
+
+def test_decodes_string_and_map_bodies(receiver):
+    now = time.time_ns()
+    request = export_request(
+        {'timeUnixNano': str(now), 'body': {'stringValue': json.dumps(activity('json', 5))}},
+        {'timeUnixNano': str(now + 1), 'body': kvlist(activity('map', 15))},
+    )
+    response = post(receiver, gzip.compress(json.dumps(request).encode()),
+                    **{'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+    assert response.status_code == 200
+
+    assert sessions(receiver)['json'].flow_count == 1
+    assert sessions(receiver)['map'].error_count == 1
+    assert sessions(receiver)['map'].last_seen == now + 1
+
+
+def test_unset_time_falls_back_to_observed_time(receiver):
+    observed = time.time_ns()
+    request = export_request(
+        {'timeUnixNano': '0', 'observedTimeUnixNano': str(observed), 'body': kvlist(activity('server', 5))},
+    )
+    assert post(receiver, json.dumps(request), **{'Content-Type': 'application/json'}).status_code == 200
+    assert sessions(receiver)['server'].last_seen == observed
+
+
+def test_invalid_record_is_skipped_without_failing_export(receiver):
+    now = time.time_ns()
+    request = export_request(
+        {'timeUnixNano': 'soon', 'body': kvlist(activity('bad-time', 5))},
+        {'timeUnixNano': str(now), 'body': {'stringValue': 'not json'}},
+        {'timeUnixNano': str(now), 'body': kvlist(activity('good', 5))},
+    )
+    assert post(receiver, json.dumps(request), **{'Content-Type': 'application/json'}).status_code == 200
+    assert set(sessions(receiver)) == {'good'}
+
+
+def test_undecodable_body_is_rejected(receiver):
+    assert post(receiver, b'{', **{'Content-Type': 'application/json'}).status_code == 400
+
+
+def test_decodes_protobuf(receiver):
+    logs_service_pb2 = pytest.importorskip('opentelemetry.proto.collector.logs.v1.logs_service_pb2')
+    from google.protobuf.json_format import ParseDict
+
+    now = time.time_ns()
+    request = ParseDict(export_request({'timeUnixNano': str(now), 'body': kvlist(activity('server', 5))}),
+                        logs_service_pb2.ExportLogsServiceRequest())
+    response = post(receiver, request.SerializeToString(), **{'Content-Type': 'application/x-protobuf'})
+    assert response.status_code == 200
+    assert sessions(receiver)['server'].flow_count == 1
+    assert sessions(receiver)['server'].last_seen == now
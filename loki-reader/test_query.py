@@ -0,0 +1,88 @@
+"""
+query_range reads against fake_loki.py: stream cursors and the paging of
+truncated results.
+
+    python -m pytest test_query.py
+"""
+import os
+import tempfile
+
+# Keep the tests away from the service's logs
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'loki-reader-tests'))
+
+import pytest
+
+from fake_loki import FakeLoki, activity_log
+from loki_reader import Config, LokiLogReader, StreamCursor
+
+LABELS = {'app': 'otel-collector', 'pod': 'collector-0'}
+SECOND_NS = 1_000_000_000
+BASE_NS = 1_700_000_000 * SECOND_NS
+
+
+@pytest.fixture
+def loki(monkeypatch):
+    fake = FakeLoki().start()
+    monkeypatch.setattr(Config, 'LOKI_SERVER_HOST', fake.host)
+    monkeypatch.setattr(Config, 'LOKI_SERVER_PORT', fake.port)
+    monkeypatch.setattr(Config, 'INGEST_MODE', 'window')
+    monkeypatch.setattr(Config, 'METRICS_SINK', 'http')
+    monkeypatch.setattr(Config, 'CHECKPOINT_INTERVAL_SECONDS', 0)
+    yield fake
+    fake.stop()
+
+
+def test_cursor_breaks_timestamp_ties_by_entries_consumed():
+    cursor = StreamCursor()
+    cursor.begin()
+    assert cursor.accept('stream', 100)
+    assert cursor.accept('stream', 200)
+    assert cursor.accept('stream', 200)
+    assert cursor.positions['stream'] == [200, 2]
+
+    # An overlapping query returns both entries at 200 again, then a third one
+    cursor.begin()
+    assert not cursor.accept('stream', 100)
+    assert not cursor.accept('stream', 200)
+    assert not cursor.accept('stream', 200)
+    assert cursor.accept('stream', 200)
+    assert cursor.accept('stream', 300)
+    assert cursor.positions['stream'] == [300, 1]
+
+
+def test_cursor_tracks_streams_independently():
+    cursor = StreamCursor()
+    cursor.begin()
+    assert cursor.accept('a', 100)
+    assert cursor.accept('b', 100)
+    assert cursor.start_time(0) == 100
+    cursor.prune(150)
+    assert cursor.positions == {}
+
+
+def test_split_range_covers_rest_of_window_at_page_density(loki):
+    reader = LokiLogReader()
+    # The first page covered 10s, so the remaining 25s take 3 sub-ranges
+    ranges = reader._split_range(0, 10 * SECOND_NS, 35 * SECOND_NS, 100)
+    assert len(ranges) == 3
+    assert ranges[0][0] == 10 * SECOND_NS
+    assert ranges[-1][1] == 35 * SECOND_NS
+    assert all(previous[1] == following[0] for previous, following in zip(ranges, ranges[1:]))
+
+    # A page filled within one instant is taken to cover at least a second
+    assert len(reader._split_range(0, 0, 5 * SECOND_NS, 100)) == 5
+
+
+def test_truncated_results_are_paged_without_gaps_or_duplicates(loki):
+    timestamps = [BASE_NS + i * SECOND_NS for i in range(25)]
+    # Three entries share the timestamp where the first page is cut off
+    timestamps[9:12] = [timestamps[9]] * 3
+    for i, timestamp in enumerate(timestamps):
+        loki.push(LABELS, activity_log(f'server-{i}', 'project', 5, timestamp), timestamp)
+
+    reader = LokiLogReader()
+    entries = list(reader.get_logs(Config.LOKI_QUERY, BASE_NS, BASE_NS + 60 * SECOND_NS, limit=10))
+
+    assert loki.truncated_count >= 1
+    assert sorted(entry.server_id for entry in entries) == sorted(f'server-{i}' for i in range(25))
+    assert [entry.timestamp for entry in entries] == sorted(timestamps)
@@ -0,0 +1,156 @@
+"""
+MetricsState building blocks: deduplication, last-hour windows, deadlines and
+pushed-down message counts.
+
+    python -m pytest test_state.py
+"""
+import os
+import tempfile
+
+# Keep the tests away from the service's logs
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'loki-reader-tests'))
+
+import pytest
+
+from loki_reader import (Config, DeadlineScheduler, EventDeduplicator, MetricsState, ServerSession,
+                         SlidingWindowCounter)
+
+SECOND_NS = 1_000_000_000
+MINUTE_NS = 60 * SECOND_NS
+HOUR_NS = 60 * MINUTE_NS
+
+
+@pytest.fixture(autouse=True)
+def http_sink(monkeypatch):
+    monkeypatch.setattr(Config, 'METRICS_SINK', 'http')
+
+
+def test_dedup_drops_repeated_keys_and_keeps_distinct_events_at_one_timestamp():
+    dedup = EventDeduplicator(lateness_ns=10, capacity=100)
+    assert not dedup.seen('a', 100)
+    assert not dedup.seen('b', 100)
+    assert dedup.seen('a', 100)
+
+
+def test_dedup_watermark_trails_newest_event_by_lateness():
+    dedup = EventDeduplicator(lateness_ns=10, capacity=100)
+    dedup.seen('newest', 100)
+    assert dedup.watermark == 90
+    assert not dedup.seen('on-time', 90)
+    assert dedup.seen('late', 89)
+    # A catch-up admits late events without recording them
+    assert not dedup.seen('late', 89, accept_late=True)
+    assert 'late' not in dedup.index
+
+
+def test_dedup_expires_keys_behind_watermark():
+    dedup = EventDeduplicator(lateness_ns=10, capacity=100)
+    dedup.seen('old', 100)
+    dedup.seen('new', 120)
+    assert list(dedup.index) == ['new']
+    # Expired keys are still rejected, by the watermark
+    assert dedup.seen('old', 100)
+
+
+def test_dedup_eviction_at_capacity_raises_watermark_past_evicted_key():
+    dedup = EventDeduplicator(lateness_ns=1000, capacity=2)
+    for key, timestamp in (('a', 100), ('b', 101), ('c', 102)):
+        assert not dedup.seen(key, timestamp)
+    assert list(dedup.index) == ['b', 'c']
+    assert dedup.floor == 101
+    # The evicted event can no longer be counted twice
+    assert dedup.seen('a', 100)
+
+
+def test_window_counts_per_channel_and_slides_forward():
+    window = SlidingWindowCounter(HOUR_NS, MINUTE_NS, channels=2)
+    window.add(5 * MINUTE_NS, 3, channel=1)
+    window.add(10 * MINUTE_NS, 2, channel=0)
+    assert window.count(64 * MINUTE_NS, channel=1) == 3
+    assert window.count(64 * MINUTE_NS, channel=0) == 2
+    # The bucket of minute 5 leaves the hour ending at minute 65
+    assert window.count(65 * MINUTE_NS, channel=1) == 0
+    assert window.count(65 * MINUTE_NS, channel=0) == 2
+    # A jump past the whole window clears it
+    assert window.count(200 * MINUTE_NS, channel=0) == 0
+
+
+def test_window_ignores_events_older_than_window():
+    window = SlidingWindowCounter(HOUR_NS, MINUTE_NS)
+    window.add(100 * MINUTE_NS)
+    window.add(40 * MINUTE_NS)
+    assert window.count(100 * MINUTE_NS) == 1
+
+
+def test_window_widens_buckets_on_overflow():
+    window = SlidingWindowCounter(HOUR_NS, MINUTE_NS)
+    window.add(MINUTE_NS, 255)
+    assert window.buckets.typecode == 'B'
+    window.add(MINUTE_NS, 1)
+    assert window.buckets.typecode == 'H'
+    window.add(MINUTE_NS, 70000)
+    assert window.count(MINUTE_NS) == 70256
+
+
+def test_window_state_round_trip_per_channel():
+    window = SlidingWindowCounter(HOUR_NS, MINUTE_NS, channels=2)
+    window.add(50 * MINUTE_NS, 4, channel=0)
+    window.add(100 * MINUTE_NS, 3, channel=1)
+
+    restored = SlidingWindowCounter(HOUR_NS, MINUTE_NS, channels=2)
+    restored.load_state(window.to_state(0), 0)
+    restored.load_state(window.to_state(1), 1)
+    assert restored.count(100 * MINUTE_NS, 0) == 4
+    assert restored.count(100 * MINUTE_NS, 1) == 3
+    # A ring of another resolution is dropped
+    other = SlidingWindowCounter(HOUR_NS, 2 * MINUTE_NS)
+    other.load_state(window.to_state(0))
+    assert other.count(100 * MINUTE_NS) == 0
+
+
+def test_deadlines_keep_earliest_per_server():
+    deadlines = DeadlineScheduler()
+    deadlines.arm('a', 50)
+    deadlines.arm('a', 80)  # later: no-op
+    deadlines.arm('b', 30)
+    deadlines.arm('b', 20)  # earlier: supersedes
+    assert len(deadlines) == 2
+    assert list(deadlines.pop_due(40)) == ['b']
+    assert list(deadlines.pop_due(40)) == []
+    assert list(deadlines.pop_due(60)) == ['a']
+    assert len(deadlines) == 0
+
+
+def test_deadlines_skip_cancelled_servers():
+    deadlines = DeadlineScheduler()
+    deadlines.arm('a', 10)
+    deadlines.arm('b', 20)
+    deadlines.cancel('a')
+    assert list(deadlines.pop_due(30)) == ['b']
+
+
+def test_apply_counts_adds_buckets_after_session_start():
+    state = MetricsState()
+    start = 100 * MINUTE_NS + 5 * SECOND_NS
+    state.update_metrics('server', 'project', 1, start, event_key=1)
+    state.apply_counts([
+        ('server', 'project', 5, 100 * MINUTE_NS, 9),   # ended before the start
+        ('server', 'project', 5, 101 * MINUTE_NS, 4),
+        ('server', 'project', 15, 102 * MINUTE_NS, 2),
+        ('server', 'project', 3, 103 * MINUTE_NS, 1),   # activity only
+    ])
+
+    session = state.server_sessions['server']
+    assert session.flow_count == 4
+    assert session.error_count == 2
+    assert session.window.count(session.last_seen, ServerSession.FLOWS) == 4
+    assert session.window.count(session.last_seen, ServerSession.ERRORS) == 2
+    assert session.last_seen == 103 * MINUTE_NS
+
+
+def test_apply_counts_starts_unknown_servers():
+    state = MetricsState()
+    state.apply_counts([('server', 'project', 5, 101 * MINUTE_NS, 4)])
+    session = state.server_sessions['server']
+    assert session.project_key == 'project'
+    assert session.flow_count == 4
@@ -0,0 +1,130 @@
+"""
+Tail mode against fake_loki.py: reconnects and the backfill of the gap.
+
+    python -m pytest test_tail.py
+"""
+import os
+import tempfile
+import time
+
+# Keep the tests away from the service's logs
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'loki-reader-tests'))
+
+import pytest
+
+from fake_loki import FakeLoki, activity_log
+from loki_reader import Config, LokiLogReader, LokiTailStream, MetricsState, StatusMapping, StreamCursor
+
+LABELS = {'app': 'otel-collector', 'pod': 'collector-0'}
+MINUTE_NS = 60 * 1_000_000_000
+
+
+@pytest.fixture
+def loki(monkeypatch, tmp_path):
+    fake = FakeLoki().start()
+    monkeypatch.setattr(Config, 'LOKI_SERVER_HOST', fake.host)
+    monkeypatch.setattr(Config, 'LOKI_SERVER_PORT', fake.port)
+    monkeypatch.setattr(Config, 'INGEST_MODE', 'tail')
+    monkeypatch.setattr(Config, 'METRICS_SINK', 'http')
+    monkeypatch.setattr(Config, 'CHECKPOINT_INTERVAL_SECONDS', 0)
+    monkeypatch.setattr(Config, 'CURSOR_FILE', str(tmp_path / 'cursor.json'))
+    yield fake
+    fake.stop()
+
+
+def push_flow(loki, server_id, timestamp):
+    loki.push(LABELS, activity_log(server_id, 'project', 5, timestamp), timestamp)
+
+
+def flow_count(reader, server_id):
+    with reader.state_lock:
+        session = reader.metrics_state.server_sessions.get(server_id)
+        return session.flow_count if session else 0
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_backfills_gap_since_cursor_beyond_unresponsive_window(loki):
+    now = time.time_ns()
+    reader = LokiLogReader()
+    # The tail last read this stream 20 minutes ago, then lost its connection
+    reader.cursor.positions[StreamCursor.stream_key(LABELS)] = [now - 20 * MINUTE_NS, 1]
+    push_flow(loki, 'server', now - 15 * MINUTE_NS)
+    push_flow(loki, 'server', now - MINUTE_NS)
+
+    tail = LokiTailStream(reader)
+    tail.start()
+    try:
+        assert wait_for(lambda: flow_count(reader, 'server') == 2)
+    finally:
+        tail.stop()
+
+
+def test_backfilled_gap_sets_server_status_on_event_time(loki):
+    now = time.time_ns()
+    reader = LokiLogReader()
+    reader.cursor.positions[StreamCursor.stream_key(LABELS)] = [now - 20 * MINUTE_NS, 1]
+    # Active through the whole gap, a flow every 30 seconds
+    for offset in range(1, 40):
+        push_flow(loki, 'busy', now - 20 * MINUTE_NS + offset * MINUTE_NS // 2)
+    # Silent for the last 15 minutes of it
+    push_flow(loki, 'quiet', now - 15 * MINUTE_NS)
+
+    tail = LokiTailStream(reader)
+    tail.start()
+    try:
+        assert wait_for(lambda: tail.connected)
+        assert wait_for(lambda: reader.metrics_state.catch_up_clock is None)
+        with reader.state_lock:
+            sessions = reader.metrics_state.server_sessions
+            assert sessions['busy'].flow_count == 39
+            assert sessions['busy'].status == StatusMapping.RUNNING
+            assert sessions['quiet'].status == StatusMapping.UNRESPONSIVE
+    finally:
+        tail.stop()
+
+
+def test_reconnect_counts_every_entry_once(loki):
+    reader = LokiLogReader()
+    tail = LokiTailStream(reader)
+    tail.start()
+    try:
+        assert wait_for(lambda: tail.connected)
+        push_flow(loki, 'server', time.time_ns())
+        assert wait_for(lambda: flow_count(reader, 'server') == 1)
+
+        loki.drop_tails()
+        assert wait_for(lambda: not tail.connected)
+        # Written while disconnected: only the reconnect backfill can pick it up
+        push_flow(loki, 'server', time.time_ns())
+        assert wait_for(lambda: loki.tail_count == 2 and tail.connected)
+        push_flow(loki, 'server', time.time_ns())
+
+        assert wait_for(lambda: flow_count(reader, 'server') == 3)
+        time.sleep(0.5)
+        assert flow_count(reader, 'server') == 3
+    finally:
+        tail.stop()
+
+
+def test_push_prunes_streams_silent_since_before_the_newest_entry(loki):
+    now = time.time_ns()
+    reader = LokiLogReader()
+    reader.cursor.positions = {
+        'live': [now, 1],
+        'silent': [now - MetricsState._unresponsive_timeout_ns() - 1, 1],
+    }
+    reader.push_metrics(pull=False)
+    assert set(reader.cursor.positions) == {'live'}
+
+    # Nothing is pruned while no new entries arrive, e.g. during an outage
+    reader.cursor.positions = {'only': [now - 60 * MINUTE_NS, 1]}
+    reader.push_metrics(pull=False)
+    assert set(reader.cursor.positions) == {'only'}